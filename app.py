@@ -1,7 +1,11 @@
+import threading
 import streamlit as st
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from supplier_backend import recommend_suppliers
+from supplier_backend import (base_path, load_all_csvs, recommend_suppliers, recommend_suppliers_remote,
+                              recommendation_phases, save_feedback, save_feedback_remote, service_url,
+                              start_weather_refresher, summarize_timings, warm_indexes)
 
 # Set page config
 st.set_page_config(
@@ -15,6 +19,16 @@ if 'submitted' not in st.session_state:
     st.session_state.submitted = False
 if 'result' not in st.session_state:
     st.session_state.result = None
+if 'job' not in st.session_state:
+    st.session_state.job = None
+
+PHASE_LABELS = {
+    "queued": "Waiting for a free worker...",
+    "hs_code": "Classifying product...",
+    "remote_lookups": "Fetching weather, tariff and location data...",
+    "scoring": "Scoring suppliers...",
+    "explanation": "Writing recommendation analysis..."
+}
 
 # Custom CSS
 st.markdown("""
@@ -47,21 +61,82 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-def save_feedback(supplier_name, feedback, rating):
-    feedback_data = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "supplier_name": supplier_name,
-        "feedback": feedback,
-        "rating": rating
-    }
-    
-    try:
-        feedback_df = pd.read_csv("feedback.csv")
-    except FileNotFoundError:
-        feedback_df = pd.DataFrame(columns=["timestamp", "supplier_name", "feedback", "rating"])
-    
-    feedback_df = pd.concat([feedback_df, pd.DataFrame([feedback_data])], ignore_index=True)
-    feedback_df.to_csv("feedback.csv", index=False)
+@st.cache_resource(show_spinner="Loading supplier data...")
+def get_supplier_data():
+    # Loaded once per process and shared by every session
+    csv_data = load_all_csvs(base_path, snapshot=True, compact=True, stream=True)
+    warm_indexes(csv_data)
+    # Forecasts are refreshed in the background; requests never wait on the weather API
+    start_weather_refresher(csv_data)
+    return csv_data
+
+@st.cache_resource
+def get_recommendation_worker():
+    # Background executor plus in-flight jobs keyed by query
+    return {"executor": ThreadPoolExecutor(max_workers=4), "jobs": {}, "lock": threading.Lock()}
+
+def run_recommendation(job, product_category, product_name, source_location, csv_data, radius_km=None):
+    def report_phase(phase):
+        job["phase"] = phase
+
+    if service_url:
+        # Thin client: the recommendation service holds the data and warm caches
+        result = recommend_suppliers_remote(
+            product_category=product_category,
+            product_name=product_name,
+            source_location=source_location,
+            url=service_url,
+            progress_callback=report_phase,
+            stream_explanation=True,
+            include_timings=True,
+            radius_km=radius_km
+        )
+    else:
+        result = recommend_suppliers(
+            product_category=product_category,
+            product_name=product_name,
+            source_location=source_location,
+            csv_data=csv_data,
+            progress_callback=report_phase,
+            stream_explanation=True,
+            include_timings=True,
+            radius_km=radius_km
+        )
+    # Ranked suppliers can be shown while the explanation is still being generated
+    job["top_suppliers"] = result["top_suppliers"]
+    for chunk in result["explanation"]:
+        job["explanation_parts"].append(chunk)
+    return {"top_suppliers": result["top_suppliers"], "explanation": "".join(job["explanation_parts"]),
+            "timings": result["timings"]}
+
+def submit_recommendation(product_category, product_name, source_location, radius_km=None):
+    csv_data = None if service_url else get_supplier_data()
+    worker = get_recommendation_worker()
+    key = (product_category, product_name.strip().lower(), source_location.strip().lower(), radius_km)
+    with worker["lock"]:
+        # Only in-flight jobs are shared; repeats of a finished query go through the
+        # backend's result cache, which expires and follows dataset and feedback changes
+        for old_key in [k for k, j in worker["jobs"].items() if j["future"].done()]:
+            del worker["jobs"][old_key]
+        job = worker["jobs"].get(key)
+        if job is None:
+            job = {"phase": "queued", "top_suppliers": None, "explanation_parts": []}
+            job["future"] = worker["executor"].submit(
+                run_recommendation, job, product_category, product_name, source_location, csv_data, radius_km
+            )
+            worker["jobs"][key] = job
+    return job
+
+@st.fragment(run_every=0.5)
+def show_job_progress():
+    job = st.session_state.job
+    if job["future"].done():
+        st.rerun()
+    if job["top_suppliers"] is not None:
+        st.rerun()
+    phase = job["phase"]
+    step = recommendation_phases.index(phase) + 1 if phase in recommendation_phases else 0
+    st.progress(step / (len(recommendation_phases) + 1), text=PHASE_LABELS.get(phase, "Analyzing suppliers..."))
 
 def main():
     st.title("🛒 Supplier Recommendation System")
@@ -91,6 +166,7 @@ def main():
                 source_location = f"{city}, {country}"
             else:
                 source_location = "New York, United States"
+            max_distance = st.number_input("Max distance from you (km, 0 = any)", min_value=0, value=0, step=500)
         
         submitted = st.form_submit_button("Find Suppliers")
 
@@ -98,22 +174,37 @@ def main():
             if not product_name:
                 st.error("Please enter a product name")
             else:
-                with st.spinner("Analyzing suppliers..."):
-                    try:
-                        st.session_state.result = recommend_suppliers(
-                            product_category=product_category,
-                            product_name=product_name,
-                            source_location=source_location
-                        )
-                        st.session_state.submitted = True
-                    except Exception as e:
-                        st.error(f"Error: {str(e)}")
-                        st.stop()
+                st.session_state.job = submit_recommendation(product_category, product_name, source_location,
+                                                             radius_km=max_distance or None)
+                st.session_state.submitted = False
+
+    job = st.session_state.job
+    if job is not None:
+        if not job["future"].done():
+            if job["top_suppliers"] is None:
+                show_job_progress()
+            else:
+                display_results({"top_suppliers": job["top_suppliers"]}, streaming=True)
+            return
+        st.session_state.job = None
+        try:
+            st.session_state.result = job["future"].result()
+            st.session_state.submitted = True
+        except Exception as e:
+            st.error(f"Error: {str(e)}")
+            st.stop()
 
     if st.session_state.submitted and st.session_state.result:
         display_results(st.session_state.result)
 
-def display_results(result):
+@st.fragment(run_every=0.3)
+def show_streaming_explanation():
+    job = st.session_state.job
+    if job is None or job["future"].done():
+        st.rerun()
+    st.markdown("".join(job["explanation_parts"]) + "▌")
+
+def display_results(result, streaming=False):
     top_suppliers = result.get("top_suppliers", [])
     explanation = result.get("explanation", "No explanation provided")
     
@@ -131,13 +222,14 @@ def display_results(result):
             
             with col2:
                 factors = supplier.get('factors', {})
-                cols = st.columns(6)
+                cols = st.columns(7)
                 with cols[0]: st.metric("Weather", factors.get('weather_factor', 0), help="Weather risk factor")
                 with cols[1]: st.metric("Tariffs", factors.get('tariff_factor', 0), help="Tariff impact")
                 with cols[2]: st.metric("Match", factors.get('product_match_factor', 0), help="Product match")
                 with cols[3]: st.metric("Complaints", factors.get('complaint_factor', 0), help="Complaint history")
                 with cols[4]: st.metric("Distance", factors.get('distance_factor', 0), help="Proximity score")
                 with cols[5]: st.metric("Expiration", factors.get('expiration_factor', 0), help="Product freshness")
+                with cols[6]: st.metric("Feedback", factors.get('feedback_factor', 0), help="Customer ratings")
             
             with st.form(key=f"feedback_form_{i}"):
                 st.subheader("Provide Feedback on this Supplier")
@@ -145,11 +237,17 @@ def display_results(result):
                 rating = st.slider("Rating (1-5)", 1, 5, 3, key=f"rating_{i}")
                 
                 if st.form_submit_button("Submit Feedback"):
-                    save_feedback(supplier['supplier_name'], feedback, rating)
+                    if service_url:
+                        save_feedback_remote(supplier['supplier_name'], feedback, rating, url=service_url)
+                    else:
+                        save_feedback(supplier['supplier_name'], feedback, rating)
                     st.success("Thank you for your feedback!")
     
     st.markdown("### Recommendation Analysis")
-    st.markdown(explanation)
+    if streaming:
+        show_streaming_explanation()
+    else:
+        st.markdown(explanation)
     
     if top_suppliers:
         suppliers_data = []
@@ -168,5 +266,20 @@ def display_results(result):
             mime="text/csv"
         )
 
+    if result.get("timings"):
+        show_timings(result["timings"])
+
+def show_timings(timings):
+    summary = summarize_timings(timings)
+    with st.expander("Debug: request timings"):
+        st.caption("Time per phase")
+        st.dataframe(pd.DataFrame(list(summary["phases"].items()), columns=["phase", "seconds"]), hide_index=True)
+        if summary["hosts"]:
+            st.caption("Time per external host")
+            st.dataframe(pd.DataFrame.from_dict(summary["hosts"], orient="index").rename_axis("host"))
+        if summary["counters"]:
+            st.caption("Calls, retries and cache hits")
+            st.dataframe(pd.DataFrame(list(summary["counters"].items()), columns=["counter", "count"]), hide_index=True)
+
 if __name__ == "__main__":
     main()
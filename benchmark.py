@@ -0,0 +1,300 @@
+import argparse
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pandas as pd
+import supplier_backend
+# Offline benchmark for the recommendation pipeline: generates a synthetic dataforrag tree,
+# serves the weather, WTO, Nominatim and ipinfo APIs from local stub servers (plus a stub LLM
+# client), and reports per-phase wall time, external call counts and peak memory as JSON.
+#
+#   python benchmark.py --suppliers 5000 --complaints 200000 --latency 0.05 --error-rate 0.01
+# Locations used for synthetic suppliers
+bench_cities = [
+    ("Houston", "Texas"), ("Austin", "Texas"), ("Chicago", "Illinois"), ("Boston", "Massachusetts"),
+    ("Seattle", "Washington"), ("Denver", "Colorado"), ("Shanghai", "China"), ("Shenzhen", "China"),
+    ("Delhi", "India"), ("Mumbai", "India"), ("Berlin", "Germany"), ("Munich", "Germany"),
+    ("London", "United Kingdom"), ("Manchester", "United Kingdom"), ("Toronto", "Canada"),
+    ("Tehuacain", "Mexico"), ("Acme Holdings LLC", "Texas"), (None, None)
+]
+bench_issues = list(supplier_backend.severity_mapping) + ["Incorrect information on your report", "Other"]
+# Write a synthetic dataforrag tree at the requested scale; returns row counts per file
+def generate_dataset(path, suppliers=1000, products=5000, complaints=20000, seed=0):
+    rng = random.Random(seed)
+    companies = [f"Supplier {i} {rng.choice(['LLC', 'Inc', 'Corp', 'Ltd'])}" for i in range(max(1, suppliers))]
+    domains = [("goverment", "SGE", "sge", "State"), ("medical", "medical", "medical", "Country"),
+               ("gps", "GPS", "gps", "Country")]
+    sizes = {}
+    for directory, prefix, key, region_column in domains:
+        dir_path = os.path.join(path, directory)
+        os.makedirs(dir_path, exist_ok=True)
+        supplier_count = suppliers // len(domains)
+        supplier_rows = []
+        for i in range(supplier_count):
+            city, region = rng.choice(bench_cities)
+            supplier_rows.append({"ID": f"{key}-{i}", "Name": rng.choice(companies), "City": city, region_column: region})
+        product_count = products // len(domains)
+        product_rows = [{
+            "Product ID": f"{key}-p{i}",
+            "Supplier ID": f"{key}-{rng.randrange(max(1, supplier_count))}",
+            "Product Name": f"Product {i}",
+            "Expire Date": f"{rng.randint(2020, 2030)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        } for i in range(product_count)]
+        project_rows = [{"Project ID": f"{key}-proj{i}", "Name": f"Project {i}"} for i in range(10)]
+        for suffix, rows in (("suppliers", supplier_rows), ("products", product_rows), ("projects", project_rows)):
+            pd.DataFrame(rows).to_csv(os.path.join(dir_path, f"{prefix}_{suffix}.csv"), index=False)
+            sizes[f"{key}_{suffix}"] = len(rows)
+    complaint_rows = [{
+        "Date received": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "Product": "Consumer product",
+        "Issue": rng.choice(bench_issues),
+        "Company": rng.choice(companies) if rng.random() < 0.7 else f"Unrelated Company {rng.randrange(1000)}",
+        "State": rng.choice(["TX", "CA", "NY", "IL"]),
+        "Consumer complaint narrative": "Synthetic complaint narrative text " * rng.randint(1, 5)
+    } for _ in range(complaints)]
+    pd.DataFrame(complaint_rows).to_csv(os.path.join(path, "complaints-2025-03-26_03_39.csv"), index=False)
+    sizes["complaints"] = len(complaint_rows)
+    return sizes
+def _stable_fraction(text):
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+# Stub responses per service, shaped like the real APIs' responses
+def _weather_response(query):
+    location = query.get("q", [""])[0]
+    days = []
+    for day in range(14):
+        fraction = _stable_fraction(f"{location}-{day}")
+        days.append({
+            "date": f"2026-01-{day + 1:02d}",
+            "day": {
+                "avgtemp_c": 40 if fraction > 0.95 else 20,
+                "totalprecip_mm": 25 if 0.9 < fraction <= 0.95 else 2,
+                "maxwind_kph": 10,
+                "condition": {"text": "Sunny"}
+            }
+        })
+    return 200, {"location": {"name": location, "country": "Stub"}, "forecast": {"forecastday": days}}
+def _wto_response(query):
+    reporter = query.get("reporter_member_code", [""])[0]
+    product_ids = query.get("product_ids", [""])[0].split(",")
+    items = [{"product_ids": [product_id], "duty_rate": 15 if _stable_fraction(reporter + product_id) > 0.6 else 3}
+             for product_id in product_ids]
+    return 200, {"items": items}
+def _nominatim_response(query):
+    location = query.get("q", [""])[0]
+    fraction = _stable_fraction(location)
+    if fraction < 0.05:
+        return 200, []
+    return 200, [{"lat": str(fraction * 140 - 60), "lon": str(_stable_fraction(location[::-1]) * 360 - 180)}]
+def _ipinfo_response(query):
+    return 200, {"city": "Houston", "country": "US"}
+# Local HTTP stub for one external service, with configurable latency and error rate
+def start_stub_server(name, respond, latency=0.0, error_rate=0.0, seed=0):
+    stats = {"calls": 0, "errors": 0}
+    lock = threading.Lock()
+    rng = random.Random(seed)
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                stats["calls"] += 1
+                failed = rng.random() < error_rate
+                if failed:
+                    stats["errors"] += 1
+            if latency:
+                time.sleep(latency)
+            status, payload = (500, {"error": "stub failure"}) if failed else respond(parse_qs(urlparse(self.path).query))
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, format, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=f"stub-{name}", daemon=True).start()
+    return {"name": name, "server": server, "stats": stats, "lock": lock,
+            "url": f"http://127.0.0.1:{server.server_address[1]}/{name}"}
+# Stand-in for the Hugging Face client with a fixed latency per call
+class StubLLMClient:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+    def text_generation(self, prompt, stream=False, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        text = "8526" if kwargs.get("max_new_tokens", 0) <= 20 else "Stub recommendation analysis. " * 20
+        if stream:
+            return iter(text.split(" "))
+        return text
+# Point the backend at the stubs and give it fresh caches in a scratch directory
+def configure_backend(stubs, llm_client, cache_dir, rate_limits=True):
+    supplier_backend.weather_api_url = stubs["weather"]["url"]
+    supplier_backend.wto_api_url = stubs["wto"]["url"]
+    supplier_backend.nominatim_url = stubs["nominatim"]["url"]
+    supplier_backend.ipinfo_url = stubs["ipinfo"]["url"]
+    supplier_backend.client = llm_client
+    supplier_backend.geocode_cache_path = os.path.join(cache_dir, "geocode_cache.sqlite")
+    supplier_backend.hs_llm_cache_path = os.path.join(cache_dir, "hs_code_cache.json")
+    supplier_backend.weather_cache_path = None
+    supplier_backend.tariff_cache_path = None
+    # A scratch feedback store without the repo's real ratings, which would skew the rankings
+    supplier_backend.feedback_db_path = os.path.join(cache_dir, "feedback.sqlite")
+    supplier_backend.feedback_csv_path = None
+    supplier_backend.company_match_cache_path = os.path.join(cache_dir, "company_matches.json")
+    # Apply the production host limits to the stub ports so throttling is part of the measurement
+    production_limits = {
+        "weather": "api.weatherapi.com",
+        "wto": "api.wto.org",
+        "nominatim": "nominatim.openstreetmap.org"
+    }
+    for name, host in production_limits.items():
+        netloc = urlparse(stubs[name]["url"]).netloc
+        if rate_limits:
+            supplier_backend.host_limits[netloc] = supplier_backend.host_limits[host]
+        else:
+            supplier_backend.host_limits[netloc] = {"concurrency": 16, "min_interval": 0.0}
+    supplier_backend.clear_caches()
+def _reset_stub_stats(stubs, llm_client):
+    for stub in stubs.values():
+        with stub["lock"]:
+            stub["stats"].update({"calls": 0, "errors": 0})
+    llm_client.calls = 0
+def _stub_stats(stubs, llm_client):
+    calls = {name: dict(stub["stats"]) for name, stub in stubs.items()}
+    calls["llm"] = {"calls": llm_client.calls, "errors": 0}
+    return calls
+# Run fn under a timer and tracemalloc peak tracking
+def _measure(fn):
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = fn()
+    wall = time.perf_counter() - start
+    return result, wall, tracemalloc.get_traced_memory()[1] / 2**20
+# One recommend_suppliers call with per-phase wall times from its progress callback
+def _timed_recommendation(csv_data, query, stubs, llm_client, use_cache=False):
+    _reset_stub_stats(stubs, llm_client)
+    marks = []
+    def record_phase(phase):
+        marks.append((phase, time.perf_counter()))
+    result, wall, peak = _measure(lambda: supplier_backend.recommend_suppliers(
+        query["category"], query["product_name"], query["source_location"], csv_data, progress_callback=record_phase,
+        include_timings=True, use_cache=use_cache))
+    end = time.perf_counter()
+    phases = {}
+    for (phase, started), (_, finished) in zip(marks, marks[1:] + [(None, end)]):
+        phases[phase] = phases.get(phase, 0) + finished - started
+    return {
+        "wall_s": wall,
+        "phases_s": phases,
+        "calls": _stub_stats(stubs, llm_client),
+        "peak_memory_mb": peak,
+        "timings": supplier_backend.summarize_timings(result["timings"]),
+        "top_supplier": result["top_suppliers"][0]["supplier_name"] if result["top_suppliers"] else None
+    }
+def run_benchmark(args):
+    tracemalloc.start()
+    work_dir = args.data_dir or tempfile.mkdtemp(prefix="supplier-bench-")
+    data_dir = os.path.join(work_dir, "dataforrag")
+    sizes, generation_s, _ = _measure(lambda: generate_dataset(
+        data_dir, args.suppliers, args.products, args.complaints, args.seed))
+    stubs = {
+        name: start_stub_server(name, respond, args.latency, args.error_rate, args.seed)
+        for name, respond in (("weather", _weather_response), ("wto", _wto_response),
+                              ("nominatim", _nominatim_response), ("ipinfo", _ipinfo_response))
+    }
+    llm_client = StubLLMClient(args.llm_latency)
+    configure_backend(stubs, llm_client, work_dir, rate_limits=not args.no_rate_limits)
+    query = {"category": args.category, "product_name": args.product, "source_location": args.source}
+    report = {
+        "config": vars(args),
+        "dataset": {"path": data_dir, "rows": sizes, "generation_s": generation_s},
+        "runs": []
+    }
+    csv_data, load_s, load_peak = _measure(lambda: supplier_backend.load_all_csvs(
+        data_dir, compact=args.compact, stream=args.stream_complaints))
+    report["runs"].append({"name": "load_all_csvs", "wall_s": load_s, "peak_memory_mb": load_peak})
+    report["dataset"]["memory"] = supplier_backend.dataset_memory_report(csv_data)
+    # Cold run pays for every remote lookup; the warm run is served from the caches it filled
+    report["runs"].append({"name": "recommend_cold", **_timed_recommendation(csv_data, query, stubs, llm_client)})
+    report["runs"].append({"name": "recommend_warm", **_timed_recommendation(csv_data, query, stubs, llm_client)})
+    # Repeated query: the first call fills the result cache, the second is served from it
+    _timed_recommendation(csv_data, query, stubs, llm_client, use_cache=True)
+    report["runs"].append({"name": "recommend_cached",
+                           **_timed_recommendation(csv_data, query, stubs, llm_client, use_cache=True)})
+    supplier_list = supplier_backend.extract_supplier_features(csv_data)
+    scoring_fns = [("score_vectorized", supplier_backend.calculate_supplier_scores_vectorized)]
+    if args.include_loop:
+        scoring_fns.append(("score_loop", supplier_backend.calculate_supplier_scores))
+    if args.workers:
+        # The first parallel call also starts the pool, so warm it before timing
+        parallel = functools.partial(supplier_backend.calculate_supplier_scores_parallel, workers=args.workers)
+        parallel(supplier_list, csv_data, query["category"], query["product_name"], query["source_location"])
+        scoring_fns.append(("score_parallel", parallel))
+    for name, score_fn in scoring_fns:
+        _reset_stub_stats(stubs, llm_client)
+        scores, wall, peak = _measure(lambda: score_fn(
+            supplier_list, csv_data, query["category"], query["product_name"], query["source_location"]))
+        report["runs"].append({"name": name, "wall_s": wall, "peak_memory_mb": peak, "suppliers": len(scores),
+                               "calls": _stub_stats(stubs, llm_client)})
+    # Resident service: startup pays for loading and warm-up, a request then only pays for the query
+    csv_data, prepare_s, prepare_peak = _measure(lambda: supplier_backend.prepare_service_data(
+        data_dir, compact=args.compact, stream=args.stream_complaints, weather_refresh=False))
+    report["runs"].append({"name": "service_prepare", "wall_s": prepare_s, "peak_memory_mb": prepare_peak})
+    server = supplier_backend.start_service(csv_data, port=0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        _reset_stub_stats(stubs, llm_client)
+        result, wall, _ = _measure(lambda: supplier_backend.recommend_suppliers_remote(
+            query["category"], query["product_name"], query["source_location"], url))
+        report["runs"].append({"name": "recommend_service", "wall_s": wall, "calls": _stub_stats(stubs, llm_client),
+                               "top_supplier": result["top_suppliers"][0]["supplier_name"]
+                               if result["top_suppliers"] else None})
+    finally:
+        server.shutdown()
+    report["metrics"] = supplier_backend.metrics_snapshot()
+    supplier_backend.shutdown_scoring_pool()
+    for stub in stubs.values():
+        stub["server"].shutdown()
+    tracemalloc.stop()
+    return report
+def main():
+    parser = argparse.ArgumentParser(description="Offline supplier recommendation benchmark")
+    parser.add_argument("--suppliers", type=int, default=1000)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--complaints", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every stub HTTP response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of stub HTTP calls answered with 500")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds per stub LLM call")
+    parser.add_argument("--no-rate-limits", action="store_true", help="Disable production per-host limits on the stubs")
+    parser.add_argument("--compact", action="store_true", help="Load datasets in compact mode")
+    parser.add_argument("--stream-complaints", action="store_true", help="Aggregate complaints in chunks")
+    parser.add_argument("--include-loop", action="store_true", help="Also time the row-by-row scoring loop")
+    parser.add_argument("--workers", type=int, default=0, help="Also time parallel scoring with this many processes")
+    parser.add_argument("--category", default="GPS")
+    parser.add_argument("--product", default="GPS Device X200")
+    parser.add_argument("--source", default="New York, United States")
+    parser.add_argument("--data-dir", help="Directory for the synthetic dataset (default: a new temp dir)")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    # Keep backend progress messages off stdout so the report stays machine-readable
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_benchmark(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,226 @@
 import pandas as pd
+import numpy as np
 import os
+import re
+import json
+import argparse
+import heapq
+import hashlib
+import copy
+import time
+import sqlite3
+import threading
+import contextlib
+import contextvars
+import multiprocessing
+import pickle
+from multiprocessing import shared_memory
 import requests
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from difflib import SequenceMatcher
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from math import radians, sin, cos, sqrt, atan2
 from huggingface_hub import InferenceClient
-# Initialize Hugging Face client
-client = InferenceClient(
-    model="mistralai/Mistral-7B-Instruct-v0.3",
-    token="placeholder"
-)
+# Hugging Face client, created on first use so importing the module stays cheap
+client = None
+_client_lock = threading.Lock()
+def get_llm_client():
+    global client
+    with _client_lock:
+        if client is None:
+            client = InferenceClient(
+                model="mistralai/Mistral-7B-Instruct-v0.3",
+                token="placeholder"
+            )
+        return client
 # Define paths
 base_path = "dataforrag"
-# Load all CSV files
-def load_all_csvs(base_path):
-    csv_data = {}
+# Instrumentation: timing spans, call/failure/retry counters and exporter hooks
+metrics_exporters = []  # Callables that receive every finished span as a dict
+prometheus_textfile_path = None  # When set, metrics are rewritten here after each recommendation
+_metrics = {"spans": {}, "counters": {}}
+_metrics_lock = threading.Lock()
+_timing_collector = contextvars.ContextVar("timing_collector", default=None)
+def _metric_name(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+def count(name, amount=1, **labels):
+    key = _metric_name(name, labels)
+    collector = _timing_collector.get()
+    with _metrics_lock:
+        _metrics["counters"][key] = _metrics["counters"].get(key, 0) + amount
+        if collector is not None:
+            collector["counters"][key] = collector["counters"].get(key, 0) + amount
+def _record_span(name, labels, duration, failed, collector=None):
+    key = _metric_name(name, labels)
+    with _metrics_lock:
+        stats = _metrics["spans"].setdefault(key, {"count": 0, "total_s": 0.0, "max_s": 0.0, "errors": 0})
+        stats["count"] += 1
+        stats["total_s"] += duration
+        stats["max_s"] = max(stats["max_s"], duration)
+        stats["errors"] += int(failed)
+    span = {"name": name, "labels": labels, "duration_s": duration, "error": failed, "finished_at": time.time()}
+    collector = collector or _timing_collector.get()
+    if collector is not None:
+        collector["spans"].append(span)
+    for exporter in metrics_exporters:
+        try:
+            exporter(span)
+        except Exception as e:
+            print(f"Metrics exporter error: {str(e)}")
+# Time a block as a span; an external call is marked with a host label
+@contextlib.contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        _record_span(name, labels, time.perf_counter() - start, failed)
+# Time consumption of a streamed response, recording the span once it is exhausted. The collector
+# and start time are taken now, since the stream is usually consumed after the request's context is reset
+def _timed_stream(chunks, name, **labels):
+    return _timed_chunks(chunks, name, labels, _timing_collector.get(), time.perf_counter())
+def _timed_chunks(chunks, name, labels, collector, start):
+    failed = False
+    try:
+        yield from chunks
+    except Exception:
+        failed = True
+        raise
+    finally:
+        _record_span(name, labels, time.perf_counter() - start, failed, collector)
+# Run fn in pool threads with the caller's context, so its spans reach the caller's collector
+def _with_context(fn):
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+def metrics_snapshot():
+    with _metrics_lock:
+        return {"spans": {key: dict(stats) for key, stats in _metrics["spans"].items()},
+                "counters": dict(_metrics["counters"])}
+def reset_metrics():
+    with _metrics_lock:
+        _metrics["spans"].clear()
+        _metrics["counters"].clear()
+# Exporter that prints each span as one JSON log line
+def json_log_exporter(span):
+    print(json.dumps({"event": "span", **span}, default=str))
+# All metrics in the Prometheus text exposition format
+def render_prometheus_metrics():
+    snapshot = metrics_snapshot()
+    lines = []
+    for key, stats in sorted(snapshot["spans"].items()):
+        name, _, labels = key.partition("{")
+        labels = "{" + labels if labels else ""
+        lines.append(f"supplier_{name}_seconds_total{labels} {stats['total_s']}")
+        lines.append(f"supplier_{name}_seconds_max{labels} {stats['max_s']}")
+        lines.append(f"supplier_{name}_count{labels} {stats['count']}")
+        lines.append(f"supplier_{name}_errors_total{labels} {stats['errors']}")
+    for key, value in sorted(snapshot["counters"].items()):
+        lines.append(f"supplier_{key.replace('{', '_total{', 1) if '{' in key else key + '_total'} {value}")
+    return "\n".join(lines) + "\n"
+# Write all metrics for the node_exporter textfile collector
+def write_prometheus_metrics(path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus_metrics())
+    os.replace(tmp_path, path)
+# Summarize collected spans: total time per phase and per external host
+def summarize_timings(timings):
+    phases = {}
+    hosts = {}
+    for span in list(timings["spans"]):
+        host = span["labels"].get("host")
+        if host:
+            stats = hosts.setdefault(host, {"calls": 0, "total_s": 0.0, "errors": 0})
+            stats["calls"] += 1
+            stats["total_s"] += span["duration_s"]
+            stats["errors"] += int(span["error"])
+        else:
+            phases[span["name"]] = phases.get(span["name"], 0.0) + span["duration_s"]
+    return {"phases": phases, "hosts": hosts, "counters": dict(timings["counters"])}
+# External service endpoints
+weather_api_url = "http://api.weatherapi.com/v1/forecast.json"
+wto_api_url = "https://api.wto.org/qrs/qrs"
+nominatim_url = "https://nominatim.openstreetmap.org/search"
+ipinfo_url = "https://ipinfo.io/json"
+# Per-host HTTP limits: concurrent requests and minimum seconds between request starts.
+# Keys are hostnames, or host:port to limit one port only
+host_limits = {
+    "nominatim.openstreetmap.org": {"concurrency": 1, "min_interval": 1.0},  # Nominatim usage policy
+    "api.wto.org": {"concurrency": 2, "min_interval": 0.2},  # WTO subscription quota
+    "api.weatherapi.com": {"concurrency": 8, "min_interval": 0.0}
+}
+default_host_limit = {"concurrency": 4, "min_interval": 0.0}
+http_timeout = 30
+http_max_retries = 1  # Retries for connection errors, 429 and 5xx responses
+prefetch_workers = 16
+_http_hosts = {}
+_http_hosts_lock = threading.Lock()
+# Shared keep-alive session and rate limiter state for one host
+def _host_state(netloc, hostname):
+    with _http_hosts_lock:
+        state = _http_hosts.get(netloc)
+        if state is None:
+            limit = host_limits.get(netloc) or host_limits.get(hostname) or default_host_limit
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=limit["concurrency"])
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            state = {
+                "session": session,
+                "semaphore": threading.BoundedSemaphore(limit["concurrency"]),
+                "min_interval": limit["min_interval"],
+                "lock": threading.Lock(),
+                "last_request": 0.0
+            }
+            _http_hosts[netloc] = state
+        return state
+# GET through the pooled session for the URL's host, honoring its limits
+def http_get(url, headers=None):
+    parsed = urlparse(url)
+    host = parsed.hostname
+    state = _host_state(parsed.netloc, host)
+    for attempt in range(http_max_retries + 1):
+        if attempt:
+            count("http_retries", host=host)
+        count("http_requests", host=host)
+        try:
+            with timed("http_request", host=host):
+                with state["semaphore"]:
+                    with state["lock"]:
+                        wait = state["last_request"] + state["min_interval"] - time.time()
+                        if wait > 0:
+                            time.sleep(wait)
+                        state["last_request"] = time.time()
+                    response = state["session"].get(url, headers=headers, timeout=http_timeout)
+        except requests.RequestException:
+            count("http_failures", host=host)
+            if attempt == http_max_retries:
+                raise
+            continue
+        if response.status_code >= 400:
+            count("http_failures", host=host)
+            if (response.status_code == 429 or response.status_code >= 500) and attempt < http_max_retries:
+                continue
+        return response
+# Columnar snapshots need pyarrow; without it loading always parses the CSVs
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+use_csv_snapshots = False  # Default for load_all_csvs(snapshot=None)
+# Try different encodings
+csv_encodings = ['utf-8', 'latin1', 'iso-8859-1', 'cp1252']
+# Dataset key and path for every CSV file under base_path
+def _dataset_files(base_path):
     # Define file mappings
     directories = {
         "goverment": ["SGE_projects.csv", "SGE_products.csv", "SGE_suppliers.csv"],
@@ -21,44 +229,417 @@ def load_all_csvs(base_path):
     }
     # Root-level files
     root_files = ["complaints-2025-03-26_03_39.csv"]
-    # Try different encodings
-    encodings = ['utf-8', 'latin1', 'iso-8859-1', 'cp1252']
-    # Load directory files
-    for directory, files in directories.items():
+    files = []
+    for directory, file_names in directories.items():
         dir_path = os.path.join(base_path, directory)
         if os.path.exists(dir_path):
-            for file in files:
+            for file in file_names:
                 file_path = os.path.join(dir_path, file)
                 if os.path.exists(file_path):
                     key = f"{directory.replace('goverment', 'sge')}_{file.split('_')[1].split('.')[0].lower()}"
-                    for encoding in encodings:
-                        try:
-                            csv_data[key] = pd.read_csv(file_path, encoding=encoding, on_bad_lines='skip')
-                            print(f"Loaded {key}")
-                            break
-                        except Exception:
-                            continue
-    # Load root files
+                    files.append((key, file_path))
     for file in root_files:
         file_path = os.path.join(base_path, file)
         if os.path.exists(file_path):
-            key = "complaints"
-            for encoding in encodings:
-                try:
-                    csv_data[key] = pd.read_csv(file_path, encoding=encoding, on_bad_lines='skip')
-                    print(f"Loaded {key}")
-                    break
-                except Exception:
-                    continue
+            files.append(("complaints", file_path))
+    return files
+# Parse a CSV with the first encoding that works; returns (frame, encoding)
+def _read_csv_any_encoding(file_path, preferred_encoding=None, read_options=None):
+    encodings = [preferred_encoding] + csv_encodings if preferred_encoding else csv_encodings
+    for encoding in dict.fromkeys(encodings):
+        try:
+            return pd.read_csv(file_path, encoding=encoding, on_bad_lines='skip', **(read_options or {})), encoding
+        except Exception:
+            continue
+    return None, None
+def _read_snapshot_manifest(snapshot_dir):
+    return _load_json_cache(os.path.join(snapshot_dir, "manifest.json"))
+# Load one dataset from its Feather snapshot, rebuilding it when the source CSV changed
+def _load_with_snapshot(key, file_path, snapshot_dir, manifest, read_options=None, reader=None):
+    stat = os.stat(file_path)
+    snapshot_path = os.path.join(snapshot_dir, f"{key}.feather")
+    entry = manifest.get(key)
+    if (entry and entry["source"] == os.path.abspath(file_path) and entry["mtime"] == stat.st_mtime
+            and entry["size"] == stat.st_size and os.path.exists(snapshot_path)):
+        try:
+            return feather.read_table(snapshot_path, memory_map=True).to_pandas()
+        except Exception as e:
+            print(f"Could not read snapshot for {key}: {str(e)}")
+    if reader is None:
+        df, encoding = _read_csv_any_encoding(file_path, entry.get("encoding") if entry else None, read_options)
+    else:
+        df, encoding = reader(file_path, entry.get("encoding") if entry else None)
+    if df is None:
+        return None
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        # Uncompressed so later loads can memory-map the file
+        feather.write_feather(df, snapshot_path, compression="uncompressed")
+        manifest[key] = {
+            "source": os.path.abspath(file_path),
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "encoding": encoding
+        }
+    except Exception as e:
+        print(f"Could not write snapshot for {key}: {str(e)}")
+        manifest.pop(key, None)
+    return df
+# Compact loading: only the columns the scorer reads, with repetitive text fields as categoricals.
+# Datasets not listed here (projects, non-SGE products) are not loaded at all
+compact_loading = False
+supplier_columns = ["ID", "Name", "City", "city", "Country", "country", "State", "state"]
+compact_columns = {
+    "complaints": ["Company", "Issue"],
+    "sge_products": ["Supplier ID", "Expire Date"],
+    "gps_suppliers": supplier_columns,
+    "medical_suppliers": supplier_columns,
+    "sge_suppliers": supplier_columns
+}
+compact_categoricals = ["Company", "Issue", "City", "city", "Country", "country", "State", "state", "domain"]
+# Streaming complaints ingestion: the dump is folded chunk by chunk into per (company, issue)
+# counts and date ranges, stored as "complaint_counts" instead of the full "complaints" frame
+stream_complaints = False
+complaint_chunk_rows = 100000
+complaint_stream_columns = ["Company", "Issue", "Date received"]
+complaint_required_columns = ["Company", "Issue"]  # Scoring reads both, as build_complaint_index does
+def _fold_complaint_chunk(totals, chunk):
+    chunk = chunk.dropna(subset=["Company"])
+    received = pd.to_datetime(chunk["Date received"], errors="coerce") if "Date received" in chunk.columns else None
+    grouped = pd.DataFrame({
+        "Company": chunk["Company"].astype(str),
+        "Issue": chunk["Issue"].astype(object),
+        "received": received if received is not None else pd.NaT
+    }).groupby(["Company", "Issue"], sort=False, dropna=False)["received"].agg(["size", "min", "max"])
+    grouped.columns = ["complaint_count", "first_received", "last_received"]
+    if totals is not None:
+        grouped = pd.concat([totals, grouped]).groupby(level=[0, 1], sort=False, dropna=False).agg(
+            {"complaint_count": "sum", "first_received": "min", "last_received": "max"})
+    return grouped
+# Aggregate a complaints CSV without materializing it; peak memory is bounded by the chunk
+# size plus the (company, issue) totals. Returns (counts frame, encoding)
+def aggregate_complaints_file(file_path, preferred_encoding=None, chunk_rows=None):
+    encodings = [preferred_encoding] + csv_encodings if preferred_encoding else csv_encodings
+    for encoding in dict.fromkeys(encodings):
+        try:
+            header = pd.read_csv(file_path, encoding=encoding, nrows=0).columns
+        except pd.errors.EmptyDataError:
+            print(f"Skipping complaints file {file_path}: it is empty")
+            return None, None
+        except (UnicodeDecodeError, pd.errors.ParserError):
+            continue
+        missing = [column for column in complaint_required_columns if column not in header]
+        if missing:
+            print(f"Skipping complaints file {file_path}: missing column(s) {', '.join(missing)}")
+            return None, None
+        try:
+            totals = None
+            chunks = pd.read_csv(file_path, encoding=encoding, on_bad_lines='skip', dtype=str,
+                                 usecols=lambda column: column in complaint_stream_columns,
+                                 chunksize=chunk_rows or complaint_chunk_rows)
+            with chunks:
+                for chunk in chunks:
+                    totals = _fold_complaint_chunk(totals, chunk)
+        except (UnicodeDecodeError, pd.errors.ParserError):
+            # A decode error can surface mid-file, so the next encoding starts over
+            continue
+        if totals is None:
+            totals = _fold_complaint_chunk(None, pd.DataFrame(columns=complaint_stream_columns))
+        counts = totals.reset_index()
+        counts["complaint_count"] = counts["complaint_count"].astype("int64")
+        return counts, encoding
+    return None, None
+def _compact_read_options(columns):
+    return {
+        "usecols": lambda column: column in columns,
+        "dtype": {column: "category" for column in columns if column in compact_categoricals}
+    }
+# Load all CSV files
+def load_all_csvs(base_path, snapshot=None, snapshot_dir=None, compact=None, stream=None):
+    with timed("load_all_csvs"):
+        return _load_all_csvs(base_path, snapshot, snapshot_dir, compact, stream)
+def _load_all_csvs(base_path, snapshot, snapshot_dir, compact, stream):
+    csv_data = {}
+    if snapshot is None:
+        snapshot = use_csv_snapshots
+    if compact is None:
+        compact = compact_loading
+    if stream is None:
+        stream = stream_complaints
+    if snapshot and feather is None:
+        print("pyarrow is not installed, loading CSVs without snapshots")
+        snapshot = False
+    # Compact snapshots hold projected frames, so they live apart from the full ones
+    snapshot_dir = snapshot_dir or os.path.join(base_path, ".snapshots", *(["compact"] if compact else []))
+    manifest = _read_snapshot_manifest(snapshot_dir) if snapshot else {}
+    for key, file_path in _dataset_files(base_path):
+        read_options = None
+        reader = None
+        if stream and key == "complaints":
+            key = "complaint_counts"
+            reader = aggregate_complaints_file
+        elif compact:
+            if key not in compact_columns:
+                continue
+            read_options = _compact_read_options(compact_columns[key])
+        with timed("load_csv", dataset=key):
+            if snapshot:
+                df = _load_with_snapshot(key, file_path, snapshot_dir, manifest, read_options, reader)
+            elif reader is not None:
+                df, _ = reader(file_path)
+            else:
+                df, _ = _read_csv_any_encoding(file_path, read_options=read_options)
+        if df is not None:
+            # Identifies the source file version, see dataset_version
+            stat = os.stat(file_path)
+            df.attrs["source_version"] = f"{os.path.abspath(file_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+            csv_data[key] = df
+            print(f"Loaded {key}")
+    if snapshot and os.path.isdir(snapshot_dir):
+        _save_json_cache(manifest, os.path.join(snapshot_dir, "manifest.json"))
+    if compact:
+        _combine_supplier_frames(csv_data)
     return csv_data
-# Weather API function
-def get_weather_forecast(city, api_key="placeholder"):
+# Replace the per-domain supplier frames with one "suppliers" frame holding a categorical
+# domain column and the location columns coalesced the way build_supplier_frame reads them
+def _combine_supplier_frames(csv_data):
+    frames = []
+    versions = []
+    for key, domain in supplier_domains.items():
+        if key not in csv_data:
+            continue
+        df = csv_data.pop(key)
+        frame = pd.DataFrame(index=df.index)
+        frame["ID"] = df["ID"] if "ID" in df.columns else None
+        frame["Name"] = df["Name"] if "Name" in df.columns else "Unknown"
+        frame["City"] = _first_truthy(df, ["City", "city"])
+        frame["Country"] = _first_truthy(df, ["Country", "country", "State", "state"])
+        frame["domain"] = domain
+        frames.append(frame)
+        versions.append(df.attrs.get("source_version", key))
+    if not frames:
+        return
+    suppliers = pd.concat(frames, ignore_index=True)
+    for column in ["City", "Country", "domain"]:
+        suppliers[column] = suppliers[column].astype("category")
+    suppliers.attrs["source_version"] = ";".join(versions)
+    csv_data["suppliers"] = suppliers
+# Rows, columns and deep memory use per loaded dataset
+def dataset_memory_report(csv_data):
+    return {
+        key: {"rows": len(df), "columns": len(df.columns),
+              "memory_mb": float(df.memory_usage(deep=True).sum()) / 2**20}
+        for key, df in csv_data.items()
+    }
+# Fingerprint of a loaded dataset: source file versions for frames from load_all_csvs,
+# object identity for frames built in memory
+def dataset_version(csv_data):
+    parts = [f"{key}:{csv_data[key].attrs.get('source_version') or id(csv_data[key])}:{len(csv_data[key])}"
+             for key in sorted(csv_data)]
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()[:16]
+# Load a JSON cache file of {key: {"fetched_at": ..., "value": ...}} entries
+def _load_json_cache(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Could not read cache file {path}: {str(e)}")
+        return {}
+# Write a JSON cache file atomically
+def _save_json_cache(cache, path):
+    if not path:
+        return
+    try:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Could not write cache file {path}: {str(e)}")
+# Normalize a free-text location so equivalent strings share one cache key
+def normalize_location(location):
+    return " ".join(location.strip().lower().split())
+# In-memory TTL cache of {key: {"fetched_at": ..., "value": ...}}, optionally mirrored to a JSON file
+def _new_cache(name):
+    return {"name": name, "entries": {}, "lock": threading.Lock(), "loaded_from": None}
+# Entries of a cache, merged with its JSON file on first use; call with cache["lock"] held
+def _cache_load(cache, path):
+    if path and cache["loaded_from"] != path:
+        cache["entries"].update(_load_json_cache(path))
+        cache["loaded_from"] = path
+    return cache["entries"]
+def _cache_get(cache, key, ttl, negative_ttl, path):
+    with cache["lock"]:
+        entry = _cache_load(cache, path).get(key)
+    if entry is not None:
+        max_age = ttl if entry["value"] is not None else negative_ttl
+        if time.time() - entry["fetched_at"] > max_age:
+            entry = None
+    count("cache_misses" if entry is None else "cache_hits", cache=cache["name"])
+    return entry
+def _cache_put(cache, key, entry, path, persist=True):
+    entry["fetched_at"] = time.time()
+    with cache["lock"]:
+        cache["entries"][key] = entry
+        if persist:
+            _save_json_cache(cache["entries"], path)
+def _cache_save(cache, path):
+    if path:
+        with cache["lock"]:
+            _save_json_cache(cache["entries"], path)
+# Weather forecast cache settings
+weather_cache_ttl = 3600  # Forecasts change hourly at most
+weather_negative_cache_ttl = 300  # Locations the API could not resolve (failed requests aren't cached)
+weather_cache_path = None  # Set to a JSON file path to persist forecasts across restarts
+_weather_cache = _new_cache("weather")
+# Weather API function (cached per normalized location)
+def get_weather_forecast(city, api_key="placeholder", persist=True):
     if not isinstance(city, str) or not city.strip():
         return None
-    city = city.strip()
+    key = normalize_location(city)
+    entry = _cache_get(_weather_cache, key, weather_cache_ttl, weather_negative_cache_ttl, weather_cache_path)
+    if entry is not None:
+        return entry["value"]
+    weather_data, cacheable = _fetch_weather_forecast(city.strip(), api_key)
+    if cacheable:
+        _cache_put(_weather_cache, key, {"value": weather_data}, weather_cache_path, persist)
+    return weather_data
+# Fetch forecasts for many locations, asking for each distinct location once
+def get_weather_forecasts(locations, api_key="placeholder"):
+    # While the background refresher runs, requests only read what it has published
+    if weather_refresher_running():
+        return read_weather_store(locations)
+    distinct = {}
+    for location in locations:
+        if isinstance(location, str) and location.strip():
+            distinct.setdefault(normalize_location(location), location)
+    with timed("weather_lookup"), ThreadPoolExecutor(max_workers=prefetch_workers) as pool:
+        fetch = _with_context(lambda location: get_weather_forecast(location, api_key, persist=False))
+        fetched = dict(zip(distinct.keys(), pool.map(fetch, distinct.values())))
+    forecasts = {
+        location: fetched[normalize_location(location)]
+        if isinstance(location, str) and location.strip() else None
+        for location in locations
+    }
+    _cache_save(_weather_cache, weather_cache_path)
+    return forecasts
+# Background weather refresh settings. While the refresher runs, requests only read the forecasts
+# it has published to the weather cache and never call the weather API themselves
+weather_refresh_interval = 900  # Seconds between refresh cycles
+weather_refresh_budget = 200  # Weather API calls allowed per cycle
+weather_refresh_age = 3000  # Forecasts older than this are due for a refresh
+weather_max_staleness = 24 * 3600  # Older forecasts are treated as missing (neutral weather factor)
+# "version" counts refresh cycles that published forecasts, so results scored with a location still
+# missing (neutral) can be told apart from ones scored after it was published
+_weather_refresher = {"thread": None, "stop": None, "locations": [], "demand": {}, "version": 0,
+                     "lock": threading.Lock()}
+def weather_refresher_running():
+    thread = _weather_refresher["thread"]
+    return thread is not None and thread.is_alive()
+# Count requests for locations so frequently recommended ones are refreshed first
+def note_weather_demand(locations):
+    with _weather_refresher["lock"]:
+        demand = _weather_refresher["demand"]
+        for location in locations:
+            if isinstance(location, str) and location.strip():
+                key = normalize_location(location)
+                demand[key] = demand.get(key, 0) + 1
+# Published forecasts for the given locations, without calling the API. Locations that have not
+# been refreshed yet are left out (scored as neutral) and counted as demand for the next cycle
+def read_weather_store(locations):
+    forecasts = {}
+    pending = []
+    for location in locations:
+        if not isinstance(location, str) or not location.strip():
+            continue
+        entry = _cache_get(_weather_cache, normalize_location(location), weather_max_staleness,
+                           weather_max_staleness, weather_cache_path)
+        if entry is None:
+            pending.append(location)
+        else:
+            forecasts[location] = entry["value"]
+    note_weather_demand(pending)
+    return forecasts
+# Locations due for a refresh, most requested first, then least recently refreshed
+def _weather_refresh_candidates(locations, now):
+    with _weather_refresher["lock"]:
+        demand = dict(_weather_refresher["demand"])
+    with _weather_cache["lock"]:
+        entries = _cache_load(_weather_cache, weather_cache_path)
+        ages = {}
+        for location in dict.fromkeys(locations):
+            key = normalize_location(location)
+            entry = entries.get(key)
+            ages[location] = now - entry["fetched_at"] if entry is not None else float("inf")
+            # Locations the API could not resolve are retried rarely; failed requests aren't stored,
+            # so those locations stay due and are retried next cycle
+            if entry is not None and entry["value"] is None and ages[location] < weather_max_staleness:
+                ages[location] = 0
+    due = [location for location, age in ages.items() if age >= weather_refresh_age]
+    due.sort(key=lambda location: (-demand.get(normalize_location(location), 0), -ages[location]))
+    return due
+# One refresh cycle: fetch up to budget due forecasts and publish them to the weather cache
+def refresh_weather(locations=None, budget=None, api_key="placeholder"):
+    if locations is None:
+        locations = _weather_refresher["locations"]
+    budget = weather_refresh_budget if budget is None else budget
+    selected = _weather_refresh_candidates(locations, time.time())[:budget]
+    def refresh(location):
+        weather_data, cacheable = _fetch_weather_forecast(location.strip(), api_key)
+        if cacheable:
+            _cache_put(_weather_cache, normalize_location(location), {"value": weather_data}, weather_cache_path,
+                       persist=False)
+        return cacheable
+    published = 0
+    if selected:
+        with timed("weather_refresh"), ThreadPoolExecutor(max_workers=prefetch_workers) as pool:
+            published = sum(pool.map(_with_context(refresh), selected))
+        _cache_save(_weather_cache, weather_cache_path)
+    count("weather_refreshed", published)
+    count("weather_refresh_failures", len(selected) - published)
+    # Halve demand each cycle so priorities follow recent requests
+    with _weather_refresher["lock"]:
+        _weather_refresher["demand"] = {key: value // 2 for key, value in _weather_refresher["demand"].items()
+                                        if value > 1}
+        if published:
+            _weather_refresher["version"] += 1
+    print(f"Refreshed weather for {published} of {len(selected)} locations")
+    return published
+def _weather_refresh_loop(stop):
+    while not stop.is_set():
+        try:
+            refresh_weather()
+        except Exception as e:
+            print(f"Weather refresh error: {str(e)}")
+        stop.wait(weather_refresh_interval)
+# Start (or point at new data) the background refresher for every supplier location in csv_data
+def start_weather_refresher(csv_data):
+    locations = build_supplier_frame(extract_supplier_features(csv_data))["location"].dropna().unique().tolist()
+    with _weather_refresher["lock"]:
+        _weather_refresher["locations"] = locations
+        if weather_refresher_running():
+            return
+        stop = threading.Event()
+        thread = threading.Thread(target=_weather_refresh_loop, args=(stop,), name="weather-refresher", daemon=True)
+        _weather_refresher.update({"thread": thread, "stop": stop})
+        thread.start()
+def stop_weather_refresher():
+    with _weather_refresher["lock"]:
+        thread, stop = _weather_refresher["thread"], _weather_refresher["stop"]
+        _weather_refresher.update({"thread": None, "stop": None})
+    if thread is not None:
+        stop.set()
+        thread.join()
+# weatherapi.com error code for "No matching location found"
+weather_unknown_location_code = 1006
+# Query weatherapi.com and summarize extreme weather over the next 14 days. Returns (summary, cacheable):
+# an unknown location gives (None, True), a failed request (None, False) so it is retried
+def _fetch_weather_forecast(city, api_key):
     try:
-        url = f"http://api.weatherapi.com/v1/forecast.json?key={api_key}&q={city}&days=14&aqi=no&alerts=no"
-        response = requests.get(url)
+        url = f"{weather_api_url}?key={api_key}&q={city}&days=14&aqi=no&alerts=no"
+        response = http_get(url)
         if response.status_code == 200:
             data = response.json()
             # print("got weather data")
@@ -117,14 +698,18 @@ def get_weather_forecast(city, api_key="placeholder"):
                 "forecast": forecast_days,
                 "has_extreme_weather": has_extreme_weather,
                 "extreme_weather_days": extreme_weather_count
-            }
+            }, True
         elif response.status_code == 400 and city == "Tehuacain":
-            return get_weather_forecast("Tehuacán", api_key)
+            return _fetch_weather_forecast("Tehuacán", api_key)
+        elif response.status_code == 400:
+            # weatherapi.com answered but found no such place: remember that
+            error = response.json().get("error", {})
+            return None, error.get("code") == weather_unknown_location_code
         else:
-            return None
+            return None, False
     except Exception as e:
         print(f"Weather API error for {city}: {str(e)}")
-        return None
+        return None, False
 # WTO country codes and HS product codes
 wto_country_codes = {
     "United States": "C840",
@@ -133,32 +718,104 @@ wto_country_codes = {
     "Germany": "C276",
     "United Kingdom": "C826"
 }
-def get_hs_code_for_product(product_name, product_category):
-    """Determine HS code for a product using LLM with improved fallback"""
-    # Define default HS codes mapping with more comprehensive categories
-    default_hs_codes = {
-        "GPS": "8526",  # Radar, radio navigation, and remote control equipment
-        "Navigation": "8526",  # Radar, radio navigation, and remote control equipment
-        "Medical": "9018",  # Medical/surgical/dental/veterinary instruments
-        "Pharmaceutical": "3004",  # Medicaments
-        "Electronics": "8517",  # Telephone and communication equipment
-        "Computer": "8471",  # Computing machinery
-        "Software": "8523",  # Storage media
-        "Automobile": "8703",  # Motor vehicles
-        "Machinery": "8479",  # Machinery with individual functions
-        "Textile": "6001",  # Textile fabrics
-        "Food": "2106",  # Food preparations
-        "Chemical": "3824",  # Chemical products
-        "Metal": "7326",  # Articles of iron or steel
-        "Plastic": "3926",  # Articles of plastics
-        "Wood": "4421",  # Articles of wood
-        "Furniture": "9403",  # Other furniture
-        "Lighting": "9405",  # Lamps and lighting fittings
-        "Tool": "8207",  # Interchangeable tools
-        "Toy": "9503",  # Toys and models
-        "Sports": "9506"   # Sports equipment
-    }
-    # Try to get HS code from LLM
+# Default HS codes mapping with more comprehensive categories
+default_hs_codes = {
+    "GPS": "8526",  # Radar, radio navigation, and remote control equipment
+    "Navigation": "8526",  # Radar, radio navigation, and remote control equipment
+    "Medical": "9018",  # Medical/surgical/dental/veterinary instruments
+    "Pharmaceutical": "3004",  # Medicaments
+    "Electronics": "8517",  # Telephone and communication equipment
+    "Computer": "8471",  # Computing machinery
+    "Software": "8523",  # Storage media
+    "Automobile": "8703",  # Motor vehicles
+    "Machinery": "8479",  # Machinery with individual functions
+    "Textile": "6001",  # Textile fabrics
+    "Food": "2106",  # Food preparations
+    "Chemical": "3824",  # Chemical products
+    "Metal": "7326",  # Articles of iron or steel
+    "Plastic": "3926",  # Articles of plastics
+    "Wood": "4421",  # Articles of wood
+    "Furniture": "9403",  # Other furniture
+    "Lighting": "9405",  # Lamps and lighting fittings
+    "Tool": "8207",  # Interchangeable tools
+    "Toy": "9503",  # Toys and models
+    "Sports": "9506"   # Sports equipment
+}
+# HS classification settings
+hs_nomenclature_path = None  # Optional CSV of HS headings with code and description columns
+hs_confidence_threshold = 0.5  # Below this the local classifier's answer counts as low confidence
+hs_llm_fallback = False  # Ask the LLM for low-confidence products (opt-in)
+hs_llm_cache_path = "hs_code_cache.json"  # Persisted (product name, category) -> HS answers from the LLM
+_hs_index = {"source": None, "tokens": {}}
+_hs_llm_cache = _new_cache("hs_llm")
+_hs_stopwords = {"and", "or", "of", "the", "for", "with", "in", "on", "to", "a", "an", "not", "other", "than",
+                 "whether", "parts", "thereof", "articles", "similar", "etc", "including", "n", "e", "s"}
+def _hs_tokens(text):
+    tokens = []
+    for token in re.findall(r"[a-z0-9]+", str(text).lower()):
+        # Fold simple plurals so "Electronics" and "electronic" share a token
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        if token not in _hs_stopwords:
+            tokens.append(token)
+    return tokens
+# Build the token -> {HS heading: weight} index from the built-in map and the nomenclature file
+def build_hs_index(nomenclature_path=None):
+    index = {}
+    if nomenclature_path and os.path.exists(nomenclature_path):
+        nomenclature = pd.read_csv(nomenclature_path, dtype=str)
+        columns = {column.lower().replace(" ", "_"): column for column in nomenclature.columns}
+        code_column = columns.get("hs_code") or columns.get("code") or nomenclature.columns[0]
+        description_column = columns.get("description") or nomenclature.columns[1]
+        token_codes = {}
+        for code, description in zip(nomenclature[code_column], nomenclature[description_column]):
+            digits = re.sub(r"\D", "", str(code))
+            if len(digits) < 4 or pd.isna(description):
+                continue
+            for token in set(_hs_tokens(description)):
+                token_codes.setdefault(token, set()).add(digits[:4])
+        # Rare description words are more telling than common ones
+        for token, codes in token_codes.items():
+            for code in codes:
+                index.setdefault(token, {})[code] = 1.0 / len(codes)
+    for category, code in default_hs_codes.items():
+        for token in _hs_tokens(category):
+            index.setdefault(token, {})[code] = index.get(token, {}).get(code, 0) + 3.0
+    return index
+def _get_hs_index():
+    if _hs_index["source"] != (hs_nomenclature_path,):
+        _hs_index["tokens"] = build_hs_index(hs_nomenclature_path)
+        _hs_index["source"] = (hs_nomenclature_path,)
+    return _hs_index["tokens"]
+# Classify a product locally; returns (HS code, confidence between 0 and 1)
+def classify_hs_code(product_name, product_category):
+    for category, code in default_hs_codes.items():
+        if category.lower() == str(product_category).strip().lower():
+            return code, 1.0
+    index = _get_hs_index()
+    scores = {}
+    # Category words count double compared to product name words
+    for weight, text in ((2.0, product_category), (1.0, product_name)):
+        for token in _hs_tokens(text):
+            for code, token_weight in index.get(token, {}).items():
+                scores[code] = scores.get(code, 0) + weight * token_weight
+    if scores:
+        best_code = max(scores, key=scores.get)
+        return best_code, scores[best_code] / sum(scores.values())
+    # Best guess based on loose keywords
+    if "gps" in str(product_category).lower() or "navigation" in str(product_name).lower():
+        return "8526", 0.3
+    elif "medical" in str(product_category).lower() or "health" in str(product_name).lower():
+        return "9018", 0.3
+    elif "electronic" in str(product_category).lower() or "device" in str(product_name).lower():
+        return "8517", 0.3
+    return "8526", 0.0  # Default to GPS equipment as final fallback
+# Ask the LLM for an HS code, caching answers per (product name, category)
+def _llm_hs_code(product_name, product_category):
+    key = f"{str(product_name).strip().lower()}|{str(product_category).strip().lower()}"
+    entry = _cache_get(_hs_llm_cache, key, float("inf"), 0, hs_llm_cache_path)
+    if entry is not None:
+        return entry["value"]
     prompt = f"""
     As a trade expert, provide the most appropriate HS (Harmonized System) code
     for the following product:
@@ -166,108 +823,497 @@ def get_hs_code_for_product(product_name, product_category):
     Product Category: {product_category}
     Return only the 4-digit HS code without any explanation.
     """
+    count("llm_requests", host="huggingface")
     try:
-        response = client.text_generation(
-            prompt,
-            max_new_tokens=20,
-            temperature=0.1
-        )
+        with timed("llm_request", host="huggingface"):
+            response = get_llm_client().text_generation(
+                prompt,
+                max_new_tokens=20,
+                temperature=0.1
+            )
         # Extract just the numeric code
-        import re
         hs_code_match = re.search(r'\d{4}', response)
         if hs_code_match:
             hs_code = hs_code_match.group(0)
             print(f"LLM determined HS code for {product_name}: {hs_code}")
+            _cache_put(_hs_llm_cache, key, {"value": hs_code}, hs_llm_cache_path)
             return hs_code
     except Exception as e:
+        count("llm_failures", host="huggingface")
         print(f"Error getting HS code from LLM: {str(e)}")
-    # If LLM fails, try to match category or product name with default codes
-    print(f"LLM failed to provide HS code, using fallback for {product_category}")
-    # Check for direct category match
-    if product_category in default_hs_codes:
-        return default_hs_codes[product_category]
-    # Check for partial category match
-    for category, code in default_hs_codes.items():
-        if category.lower() in product_category.lower() or product_category.lower() in category.lower():
-            print(f"Partial category match: {category} -> {code}")
-            return code
-        # Also check product name for keywords
-        if category.lower() in product_name.lower():
-            print(f"Product name match: {category} -> {code}")
-            return code
-    # Default fallback based on product category with best guess
-    if "gps" in product_category.lower() or "navigation" in product_name.lower():
-        return "8526"
-    elif "medical" in product_category.lower() or "health" in product_name.lower():
-        return "9018"
-    elif "electronic" in product_category.lower() or "device" in product_name.lower():
-        return "8517"
-    else:
-        print(f"No match found, using default code 8526 for {product_name}")
-        return "8526"  # Default to GPS equipment as final fallback
-# Tariff API function
-def get_tariff_data(country_code, product_id, api_key="placeholder"):
-    url = f"https://api.wto.org/qrs/qrs?reporter_member_code={country_code}&in_force_only=true&product_ids={product_id}"
+    return None
+def get_hs_code_for_product(product_name, product_category, use_llm=None):
+    """Determine HS code for a product from the local index, optionally asking the LLM when unsure"""
+    with timed("hs_code"):
+        return _get_hs_code_for_product(product_name, product_category, use_llm)
+def _get_hs_code_for_product(product_name, product_category, use_llm):
+    hs_code, confidence = classify_hs_code(product_name, product_category)
+    if use_llm is None:
+        use_llm = hs_llm_fallback
+    if confidence < hs_confidence_threshold and use_llm:
+        llm_code = _llm_hs_code(product_name, product_category)
+        if llm_code:
+            return llm_code
+    return hs_code
+# Tariff cache settings, keyed on (WTO reporter code, HS code)
+tariff_cache_ttl = 24 * 3600
+tariff_negative_cache_ttl = 3600
+tariff_cache_path = None  # Set to a JSON file path to persist tariff lookups across restarts
+_tariff_cache = _new_cache("tariff")
+def _tariff_key(country_code, product_id):
+    return f"{country_code}|{product_id}"
+# Query the WTO QRS endpoint; product_ids may be a comma-separated list of HS codes
+def _fetch_tariff_data(country_code, product_ids, api_key="placeholder"):
+    url = f"{wto_api_url}?reporter_member_code={country_code}&in_force_only=true&product_ids={product_ids}"
     headers = {
         "Cache-Control": "no-cache",
         "Ocp-Apim-Subscription-Key": api_key
     }
     try:
-        response = requests.get(url, headers=headers)
+        response = http_get(url, headers=headers)
         if response.status_code == 200:
             # print("got tarifff data", response.json())
             return response.json()
     except Exception as e:
         print(f"Tariff API error: {str(e)}")
     return None
+def _high_tariff(tariff_data):
+    if not tariff_data:
+        return None
+    return any(item.get("duty_rate", 0) > 10 for item in tariff_data.get("items", []))
+def _store_tariff(country_code, product_id, tariff_data, persist=True):
+    entry = {"value": tariff_data, "high_tariff": _high_tariff(tariff_data)}
+    _cache_put(_tariff_cache, _tariff_key(country_code, product_id), entry, tariff_cache_path, persist)
+    return entry
+def _tariff_entry(country_code, product_id, api_key="placeholder"):
+    key = _tariff_key(country_code, product_id)
+    entry = _cache_get(_tariff_cache, key, tariff_cache_ttl, tariff_negative_cache_ttl, tariff_cache_path)
+    if entry is None:
+        entry = _store_tariff(country_code, product_id, _fetch_tariff_data(country_code, product_id, api_key))
+    return entry
+# Tariff API function (cached per reporter and HS code)
+def get_tariff_data(country_code, product_id, api_key="placeholder"):
+    return _tariff_entry(country_code, product_id, api_key)["value"]
+# Memoized "any duty rate above 10%" flag; None when no tariff data is available
+def get_high_tariff(country_code, product_id, api_key="placeholder"):
+    return _tariff_entry(country_code, product_id, api_key)["high_tariff"]
+# HS codes an item in a QRS response applies to, when the response says so
+def _item_product_codes(item):
+    codes = item.get("product_ids") or item.get("hs_codes") or item.get("product_id") or item.get("hs_code")
+    if codes is None:
+        return None
+    if isinstance(codes, str):
+        codes = codes.split(",")
+    return [str(code).strip() for code in codes]
+# Resolve every distinct (reporter, HS code) pair, sharing one QRS call per reporter
+def prefetch_tariffs(pairs, api_key="placeholder"):
+    pairs = list(dict.fromkeys(pairs))
+    missing = {}
+    for country_code, product_id in pairs:
+        key = _tariff_key(country_code, product_id)
+        if _cache_get(_tariff_cache, key, tariff_cache_ttl, tariff_negative_cache_ttl, tariff_cache_path) is None:
+            missing.setdefault(country_code, []).append(product_id)
+    def fetch_reporter(country_code):
+        product_ids = missing[country_code]
+        tariff_data = _fetch_tariff_data(country_code, ",".join(product_ids), api_key)
+        if len(product_ids) == 1 or not tariff_data:
+            for product_id in product_ids:
+                _store_tariff(country_code, product_id, tariff_data, persist=False)
+            return
+        items = tariff_data.get("items", [])
+        item_codes = [_item_product_codes(item) for item in items]
+        if any(codes is None for codes in item_codes):
+            # Items can't be attributed to HS codes, so ask for each code separately
+            for product_id in product_ids:
+                _store_tariff(country_code, product_id, _fetch_tariff_data(country_code, product_id, api_key), persist=False)
+            return
+        for product_id in product_ids:
+            product_items = [item for item, codes in zip(items, item_codes)
+                             if any(code.startswith(product_id) for code in codes)]
+            _store_tariff(country_code, product_id, {**tariff_data, "items": product_items}, persist=False)
+    if missing:
+        with timed("tariff_lookup"), ThreadPoolExecutor(max_workers=prefetch_workers) as pool:
+            list(pool.map(_with_context(fetch_reporter), missing))
+        _cache_save(_tariff_cache, tariff_cache_path)
+    return {pair: get_high_tariff(*pair, api_key) for pair in pairs}
+# High-tariff flags for several WTO reporters and one HS code
+def get_tariffs(country_codes, product_id):
+    flags = prefetch_tariffs([(code, product_id) for code in country_codes])
+    return {code: flag for (code, _), flag in flags.items()}
+# Gather every remote lookup a scoring pass needs and run them concurrently
+def prefetch_remote_data(locations, wto_codes, product_hs, source_location=None):
+    locations = list(locations)
+    with timed("remote_lookups"), ThreadPoolExecutor(max_workers=3) as pool:
+        weather = pool.submit(_with_context(get_weather_forecasts), locations)
+        tariffs = pool.submit(_with_context(get_tariffs), wto_codes, product_hs)
+        coordinates = pool.submit(_with_context(resolve_locations),
+                                  ([source_location] if source_location else []) + locations)
+        return {
+            "weather": weather.result(),
+            "tariffs": tariffs.result(),
+            "coordinates": coordinates.result()
+        }
+# Map of supplier dataset keys to domains
+supplier_domains = {
+    "gps_suppliers": "GPS",
+    "medical_suppliers": "Medical",
+    "sge_suppliers": "Government"
+}
 # Extract supplier data
 def extract_supplier_features(csv_data):
+    # Compact datasets already hold every domain in one frame
+    if "suppliers" in csv_data:
+        return [csv_data["suppliers"]]
     all_suppliers = []
-    # Map of dataset keys to domains
-    domain_map = {
-        "gps_suppliers": "GPS",
-        "medical_suppliers": "Medical",
-        "sge_suppliers": "Government"
-    }
     # Extract suppliers from each domain
-    for key, domain in domain_map.items():
+    for key, domain in supplier_domains.items():
         if key in csv_data:
             suppliers_df = csv_data[key].copy()
             suppliers_df["domain"] = domain
             all_suppliers.append(suppliers_df)
     return all_suppliers
-# Analyze complaints
-def analyze_complaints(csv_data, company_name):
-    if "complaints" not in csv_data:
-        return {"complaint_count": 0, "complaint_severity": 0}
-    complaints_df = csv_data["complaints"]
-    company_complaints = complaints_df[complaints_df["Company"] == company_name]
-    if company_complaints.empty:
-        return {"complaint_count": 0, "complaint_severity": 0}
-    # Count complaints
-    complaint_count = len(company_complaints)
-    # Define severity scores by issue type
-    severity_mapping = {
-        "Managing an account": 3,
-        "Closing an account": 4,
-        "Deposits and withdrawals": 5,
-        "Problem with a purchase": 7,
-        "Billing dispute": 6,
-        "Product not received": 8,
-        "Defective product": 9
+# Severity scores by complaint issue type
+severity_mapping = {
+    "Managing an account": 3,
+    "Closing an account": 4,
+    "Deposits and withdrawals": 5,
+    "Problem with a purchase": 7,
+    "Billing dispute": 6,
+    "Product not received": 8,
+    "Defective product": 9
+}
+# Per-company complaint aggregates, rebuilt only when the complaints frame changes
+_complaint_index = {"frame": None, "rows": 0, "index": {}}
+def build_complaint_index(complaints_df):
+    """Aggregate complaint count and mean severity per company"""
+    if complaints_df.empty:
+        return {}
+    issues = complaints_df["Issue"]
+    if isinstance(issues.dtype, pd.CategoricalDtype):
+        issues = issues.astype(object)
+    # Unknown issue types default to a severity of 5
+    severity = issues.map(severity_mapping).fillna(5)
+    grouped = severity.groupby(complaints_df["Company"], sort=False, observed=True).agg(["count", "mean"])
+    return {
+        company: {"complaint_count": int(count), "complaint_severity": float(mean)}
+        for company, count, mean in zip(grouped.index, grouped["count"], grouped["mean"])
     }
-    # Calculate average severity
-    severity_scores = [severity_mapping.get(issue, 5) for issue in company_complaints["Issue"]]
-    avg_severity = sum(severity_scores) / len(severity_scores) if severity_scores else 0
+# Same aggregates from the streamed per (company, issue) counts
+def build_complaint_index_from_counts(counts_df):
+    if counts_df.empty:
+        return {}
+    severity = counts_df["Issue"].astype(object).map(severity_mapping).fillna(5) * counts_df["complaint_count"]
+    grouped = pd.DataFrame({"count": counts_df["complaint_count"], "severity": severity}).groupby(
+        counts_df["Company"], sort=False).sum()
     return {
-        "complaint_count": complaint_count,
-        "complaint_severity": avg_severity
+        company: {"complaint_count": int(count), "complaint_severity": float(severity / count)}
+        for company, count, severity in zip(grouped.index, grouped["count"], grouped["severity"])
     }
+def get_complaint_index(csv_data):
+    if "complaint_counts" in csv_data:
+        complaints_df, build = csv_data["complaint_counts"], build_complaint_index_from_counts
+    elif "complaints" in csv_data:
+        complaints_df, build = csv_data["complaints"], build_complaint_index
+    else:
+        return {}
+    if _complaint_index["frame"] is not complaints_df or _complaint_index["rows"] != len(complaints_df):
+        _complaint_index["index"] = build(complaints_df)
+        _complaint_index["frame"] = complaints_df
+        _complaint_index["rows"] = len(complaints_df)
+    return _complaint_index["index"]
+# Fuzzy matching of supplier names to complaint companies (opt-in). Names are normalized
+# (case, punctuation, legal suffixes), candidates are blocked by shared token or name prefix,
+# and only candidates within a block are compared. The supplier -> companies mapping is
+# persisted per dataset version, so scoring looks suppliers up in a dict
+fuzzy_company_matching = False
+company_match_threshold = 0.88  # Minimum difflib similarity of normalized names
+company_match_max_block = 500  # Blocks larger than this (very common tokens) are not used
+company_match_cache_path = "company_matches.json"
+legal_suffixes = {"llc", "inc", "incorporated", "corp", "corporation", "co", "company", "ltd", "limited", "llp",
+                  "lp", "plc", "gmbh", "ag", "sa", "na"}
+_company_match_rules = 2  # Bumped whenever normalization or matching changes, invalidating stored matches
+_company_matches = {"version": None, "matches": {}, "index": {}}
+def normalize_company_name(name):
+    # Drop periods first so "L.L.C." becomes "llc" rather than "l l c"
+    tokens = re.sub(r"[^a-z0-9&]+", " ", str(name).lower().replace(".", "")).split()
+    # Legal forms only count at the end ("Co-op Foods" keeps its "co"), along with a dangling "&"/"and"
+    end = len(tokens)
+    while end and (tokens[end - 1] in legal_suffixes or tokens[end - 1] in ("&", "and")):
+        end -= 1
+    start = 1 if end > 1 and tokens[0] == "the" else 0
+    return " ".join(tokens[start:end] or tokens)
+# Tokens holding digits; names that differ in them ("Acme 1" vs "Acme 11") are different companies
+def _numeric_tokens(normalized):
+    return sorted(token for token in normalized.split() if any(char.isdigit() for char in token))
+def _company_block_keys(normalized):
+    return set(normalized.split()) | {f"prefix:{normalized[:4]}"}
+def build_company_match_index(supplier_names, company_names):
+    """Map each supplier name to the complaint companies that name the same company"""
+    by_name = {}
+    for company in company_names:
+        by_name.setdefault(normalize_company_name(company), []).append(company)
+    blocks = {}
+    for normalized in by_name:
+        for key in _company_block_keys(normalized):
+            blocks.setdefault(key, []).append(normalized)
+    matches = {}
+    for supplier in dict.fromkeys(supplier_names):
+        normalized = normalize_company_name(supplier)
+        if not normalized:
+            continue
+        if normalized in by_name:
+            matches[supplier] = by_name[normalized]
+            continue
+        candidates = set()
+        for key in _company_block_keys(normalized):
+            block = blocks.get(key, ())
+            if len(block) <= company_match_max_block:
+                candidates.update(block)
+        best, best_score = None, company_match_threshold
+        numbers = _numeric_tokens(normalized)
+        for candidate in sorted(candidates):
+            if _numeric_tokens(candidate) != numbers:
+                continue
+            matcher = SequenceMatcher(None, normalized, candidate)
+            if matcher.real_quick_ratio() < best_score or matcher.quick_ratio() < best_score:
+                continue
+            score = matcher.ratio()
+            if score > best_score or (best is None and score == best_score):
+                best, best_score = candidate, score
+        if best is not None:
+            matches[supplier] = by_name[best]
+    return matches
+def _supplier_names(csv_data):
+    names = []
+    for suppliers_df in extract_supplier_features(csv_data):
+        if "Name" in suppliers_df.columns:
+            names.extend(str(name) for name in suppliers_df["Name"].dropna().unique())
+    return names
+# Complaint aggregates keyed by supplier name, merged over every matched complaint company
+def get_supplier_complaint_index(csv_data):
+    if not fuzzy_company_matching:
+        return get_complaint_index(csv_data)
+    complaint_index = get_complaint_index(csv_data)
+    relevant = {key: df for key, df in csv_data.items()
+                if key in supplier_domains or key in ("suppliers", "complaints", "complaint_counts")}
+    version = f"{dataset_version(relevant)}:{company_match_threshold}:{_company_match_rules}"
+    if _company_matches["version"] != version:
+        stored = _load_json_cache(company_match_cache_path)
+        if stored.get("version") == version:
+            matches = stored["matches"]
+        else:
+            with timed("company_match_index"):
+                matches = build_company_match_index(_supplier_names(csv_data), list(complaint_index))
+            _save_json_cache({"version": version, "matches": matches}, company_match_cache_path)
+        index = {}
+        for supplier, companies in matches.items():
+            found = [complaint_index[company] for company in companies if company in complaint_index]
+            total = sum(info["complaint_count"] for info in found)
+            if total:
+                severity = sum(info["complaint_count"] * info["complaint_severity"] for info in found) / total
+                index[supplier] = {"complaint_count": total, "complaint_severity": severity}
+        _company_matches.update({"version": version, "matches": matches, "index": index})
+    return _company_matches["index"]
+# Analyze complaints
+def analyze_complaints(csv_data, company_name):
+    company_info = get_supplier_complaint_index(csv_data).get(company_name)
+    if company_info is None:
+        return {"complaint_count": 0, "complaint_severity": 0}
+    return dict(company_info)
+# Supplier feedback: an append-only SQLite log (WAL mode, safe for concurrent writers) plus
+# per-supplier aggregates updated in the same transaction, so scoring never re-reads the log
+feedback_db_path = "feedback.sqlite"  # Set to None to keep feedback in memory only
+feedback_csv_path = "feedback.csv"  # Legacy log, imported once when the database is created
+feedback_half_life_days = 90  # A rating loses half its weight after this many days
+feedback_prior_weight = 2  # Neutral pseudo-ratings that damp suppliers with little or stale feedback
+feedback_factor_max = 5
+_feedback_aggregates = {"path": None, "suppliers": {}, "version": 0}
+_feedback_lock = threading.Lock()
+@contextlib.contextmanager
+def _immediate_transaction(conn):
+    # Take the write lock up front so concurrent read-modify-writes of an aggregate serialize
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+def _open_feedback_db():
+    conn = sqlite3.connect(feedback_db_path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+        with _immediate_transaction(conn):
+            # Re-check under the lock in case another process created the schema first
+            if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS feedback (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "created_at REAL NOT NULL, supplier_name TEXT NOT NULL, feedback TEXT, rating INTEGER NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS feedback_aggregates (supplier_name TEXT PRIMARY KEY, "
+                    "count INTEGER NOT NULL, rating_sum REAL NOT NULL, weight REAL NOT NULL, "
+                    "weighted_rating_sum REAL NOT NULL, updated_at REAL NOT NULL)"
+                )
+                _import_feedback_csv(conn)
+                conn.execute("PRAGMA user_version = 1")
+    return conn
+def _feedback_decay(seconds):
+    return 0.5 ** (max(0.0, seconds) / (feedback_half_life_days * 86400))
+# Fold one rating into a supplier aggregate. Weights are kept decayed to updated_at, so the
+# weighted mean is a plain ratio and only the total weight needs decaying at read time
+def _updated_feedback_aggregate(aggregate, rating, created_at):
+    if aggregate is None:
+        aggregate = {"count": 0, "rating_sum": 0.0, "weight": 0.0, "weighted_rating_sum": 0.0,
+                     "updated_at": created_at}
+    aggregate = dict(aggregate)
+    if created_at >= aggregate["updated_at"]:
+        decay = _feedback_decay(created_at - aggregate["updated_at"])
+        aggregate["weight"] *= decay
+        aggregate["weighted_rating_sum"] *= decay
+        aggregate["updated_at"] = created_at
+        weight = 1.0
+    else:
+        # Older than the aggregate (e.g. imported history): weigh it as of updated_at
+        weight = _feedback_decay(aggregate["updated_at"] - created_at)
+    aggregate["count"] += 1
+    aggregate["rating_sum"] += rating
+    aggregate["weight"] += weight
+    aggregate["weighted_rating_sum"] += weight * rating
+    return aggregate
+def _append_feedback(conn, supplier_name, feedback, rating, created_at):
+    conn.execute("INSERT INTO feedback (created_at, supplier_name, feedback, rating) VALUES (?, ?, ?, ?)",
+                 (created_at, supplier_name, feedback, rating))
+    row = conn.execute(
+        "SELECT count, rating_sum, weight, weighted_rating_sum, updated_at FROM feedback_aggregates "
+        "WHERE supplier_name = ?", (supplier_name,)
+    ).fetchone()
+    previous = dict(zip(["count", "rating_sum", "weight", "weighted_rating_sum", "updated_at"], row)) if row else None
+    aggregate = _updated_feedback_aggregate(previous, rating, created_at)
+    conn.execute("INSERT OR REPLACE INTO feedback_aggregates VALUES (?, ?, ?, ?, ?, ?)",
+                 (supplier_name, aggregate["count"], aggregate["rating_sum"], aggregate["weight"],
+                  aggregate["weighted_rating_sum"], aggregate["updated_at"]))
+    return aggregate
+def _import_feedback_csv(conn):
+    if not feedback_csv_path or not os.path.exists(feedback_csv_path):
+        return
+    legacy = pd.read_csv(feedback_csv_path)
+    created = pd.to_datetime(legacy["timestamp"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    imported = 0
+    for row, created_at in zip(legacy.itertuples(index=False), created):
+        rating = pd.to_numeric(row.rating, errors="coerce")
+        if pd.isna(row.supplier_name) or pd.isna(rating) or not 1 <= rating <= 5:
+            continue
+        created_at = created_at.to_pydatetime().timestamp() if not pd.isna(created_at) else time.time()
+        feedback = None if pd.isna(row.feedback) else str(row.feedback)
+        _append_feedback(conn, str(row.supplier_name), feedback, int(rating), created_at)
+        imported += 1
+    print(f"Imported {imported} feedback entries from {feedback_csv_path}")
+def _feedback_suppliers():
+    if _feedback_aggregates["path"] != feedback_db_path:
+        suppliers = {}
+        if feedback_db_path:
+            conn = _open_feedback_db()
+            try:
+                rows = conn.execute("SELECT supplier_name, count, rating_sum, weight, weighted_rating_sum, updated_at "
+                                    "FROM feedback_aggregates").fetchall()
+            finally:
+                conn.close()
+            for name, *values in rows:
+                suppliers[name] = dict(zip(["count", "rating_sum", "weight", "weighted_rating_sum", "updated_at"], values))
+        _feedback_aggregates.update({"path": feedback_db_path, "suppliers": suppliers,
+                                     "version": _feedback_aggregates["version"] + 1})
+    return _feedback_aggregates["suppliers"]
+def save_feedback(supplier_name, feedback, rating, created_at=None):
+    """Append one rating (1-5) for a supplier and return its updated aggregate"""
+    rating = int(rating)
+    if not 1 <= rating <= 5:
+        raise ValueError(f"Rating must be between 1 and 5, got {rating}")
+    created_at = time.time() if created_at is None else created_at
+    with _feedback_lock:
+        suppliers = _feedback_suppliers()
+        if feedback_db_path:
+            conn = _open_feedback_db()
+            try:
+                with _immediate_transaction(conn):
+                    aggregate = _append_feedback(conn, supplier_name, feedback, rating, created_at)
+            finally:
+                conn.close()
+        else:
+            aggregate = _updated_feedback_aggregate(suppliers.get(supplier_name), rating, created_at)
+        suppliers[supplier_name] = aggregate
+        _feedback_aggregates["version"] += 1
+    count("feedback_saved")
+    return dict(aggregate)
+def get_feedback_aggregates():
+    """Per-supplier feedback count, rating sum and recency-weighted rating sums"""
+    with _feedback_lock:
+        return {name: dict(aggregate) for name, aggregate in _feedback_suppliers().items()}
+# Ratings map to -max..+max around the neutral 3, shrunk towards 0 when there is little or only old feedback
+def feedback_factor_for(aggregate, now=None):
+    if not aggregate or aggregate["weight"] <= 0:
+        return 0.0
+    weight = aggregate["weight"] * _feedback_decay((now or time.time()) - aggregate["updated_at"])
+    mean_rating = aggregate["weighted_rating_sum"] / aggregate["weight"]
+    confidence = weight / (weight + feedback_prior_weight)
+    return round((mean_rating - 3) / 2 * feedback_factor_max * confidence, 1) or 0.0  # No -0.0
+def get_feedback_factors(now=None):
+    now = now or time.time()
+    with _feedback_lock:
+        return {name: feedback_factor_for(aggregate, now) for name, aggregate in _feedback_suppliers().items()}
+# Phases reported to progress callbacks, in pipeline order
+recommendation_phases = ["hs_code", "remote_lookups", "scoring", "explanation"]
+def _report_progress(progress_callback, phase):
+    if progress_callback is not None:
+        progress_callback(phase)
+# Build the dataset-derived indexes up front so the first request doesn't pay for them
+def warm_indexes(csv_data):
+    get_supplier_complaint_index(csv_data)
+    get_expiration_index(csv_data)
+    _get_hs_index()
+    get_feedback_aggregates()
+# Drop every in-memory cache, index and pooled HTTP session (persisted cache files are kept)
+def clear_caches():
+    for cache in (_weather_cache, _tariff_cache, _hs_llm_cache):
+        with cache["lock"]:
+            cache["entries"].clear()
+            cache["loaded_from"] = None
+    with _geocode_lock:
+        _geocode_memo.clear()
+    with _weather_refresher["lock"]:
+        _weather_refresher["demand"].clear()
+    _complaint_index.update({"frame": None, "rows": 0, "index": {}})
+    _supplier_spatial_index.update({"coordinates": None, "index": None})
+    _company_matches.update({"version": None, "matches": {}, "index": {}})
+    _expiration_index.update({"frame": None, "rows": 0, "day": None})
+    _hs_index["source"] = None
+    with _feedback_lock:
+        _feedback_aggregates.update({"path": None, "suppliers": {}, "version": _feedback_aggregates["version"] + 1})
+    with _result_cache["lock"]:
+        _result_cache["entries"].clear()
+    with _score_tables_lock:
+        _score_tables.clear()
+    with _http_hosts_lock:
+        for state in _http_hosts.values():
+            state["session"].close()
+        _http_hosts.clear()
+# Terms that indicate a city field actually holds a company name
+company_terms = ["llc", "inc", "incorporated", "company", "corp", "corporation"]
 # Calculate supplier scores
-def calculate_supplier_scores(supplier_list, csv_data, product_category, product_name, source_location):
+def calculate_supplier_scores(supplier_list, csv_data, product_category, product_name, source_location,
+                              progress_callback=None):
     scores = []
     # Get HS code dynamically
+    _report_progress(progress_callback, "hs_code")
     product_hs = get_hs_code_for_product(product_name, product_category)
+    # Prefetch every remote lookup the loop needs instead of calling out per supplier
+    _report_progress(progress_callback, "remote_lookups")
+    supplier_frame = build_supplier_frame(supplier_list)
+    wto_codes = supplier_frame["country"].map(wto_country_codes).fillna("C840").unique()
+    remote = prefetch_remote_data(supplier_frame["location"].dropna().unique(), wto_codes, product_hs, source_location)
+    _report_progress(progress_callback, "scoring")
+    expiration_index = get_expiration_index(csv_data)
+    feedback_factors = get_feedback_factors()
     for suppliers_df in supplier_list:
         for _, supplier in suppliers_df.iterrows():
             supplier_id = supplier.get("ID")
@@ -281,7 +1327,8 @@ def calculate_supplier_scores(supplier_list, csv_data, product_category, product
                 "tariff_factor": 0,
                 "product_match_factor": 0,
                 "expiration_factor": 0,
-                "distance_factor": 0  # New factor for distance
+                "distance_factor": 0,  # New factor for distance
+                "feedback_factor": 0.0
             }
             # Factor 1: Complaints (keep as is)
             complaint_info = analyze_complaints(csv_data, supplier_name)
@@ -302,16 +1349,12 @@ def calculate_supplier_scores(supplier_list, csv_data, product_category, product
             supplier_location = None
             if supplier_city and isinstance(supplier_city, str) and len(supplier_city.strip()) > 0:
                 # Check if city field looks valid (not containing company terms)
-                company_terms = ["llc", "inc", "incorporated", "company", "corp", "corporation"]
                 if not any(keyword in supplier_city.lower() for keyword in company_terms):
                     supplier_location = f"{supplier_city}, {supplier_country}" if supplier_country else supplier_city
                     print(f"Checking weather for: {supplier_location}")
-                    weather_data = get_weather_forecast(supplier_location)
-                    if weather_data and weather_data.get("has_extreme_weather"):
-                        extreme_days = weather_data.get("extreme_weather_days", 0)
-                        factors["weather_factor"] = -min(15, extreme_days * 3)
-                    else:
-                        factors["weather_factor"] = 5
+                    # Neutral while the background refresher hasn't published this location yet
+                    factors["weather_factor"] = (weather_factor_for(remote["weather"][supplier_location])
+                                                 if supplier_location in remote["weather"] else 0)
                 else:
                     factors["weather_factor"] = 0  # Neutral if city appears invalid
             else:
@@ -319,57 +1362,33 @@ def calculate_supplier_scores(supplier_list, csv_data, product_category, product
                 factors["weather_factor"] = -5
             # Factor 3: Tariffs (keep as is)
             wto_code = wto_country_codes.get(supplier_country, "C840")
-            tariff_data = get_tariff_data(wto_code, product_hs)
-            if tariff_data:
-                high_tariff = any(item.get("duty_rate", 0) > 10 for item in tariff_data.get("items", []))
-                factors["tariff_factor"] = -10 if high_tariff else 5
-            else:
-                factors["tariff_factor"] = 0  # Neutral if no tariff data
+            factors["tariff_factor"] = tariff_factor_for(remote["tariffs"].get(wto_code))
             # Factor 4: Product category match (keep as is)
             if domain.lower() == product_category.lower():
                 factors["product_match_factor"] = 15
             else:
                 # Add slight penalty for domain mismatch
                 factors["product_match_factor"] = -5
-            # Factor 5: Check for expired products (SGE specific) (keep as is)
-            if domain == "Government" and "sge_products" in csv_data:
-                sge_products = csv_data["sge_products"]
-                supplier_products = sge_products[sge_products["Supplier ID"] == supplier_id]
-                if not supplier_products.empty and "Expire Date" in supplier_products.columns:
-                    expired_count = 0
-                    today = datetime.now()
-                    for _, product in supplier_products.iterrows():
-                        if pd.notna(product["Expire Date"]):
-                            try:
-                                expire_date = datetime.strptime(product["Expire Date"], "%Y-%m-%d")
-                                if expire_date < today:
-                                    expired_count += 1
-                            except:
-                                pass
-                    if expired_count > 0:
-                        factors["expiration_factor"] = -min(15, expired_count * 5)
+            # Factor 5: Check for expired products (SGE specific)
+            if domain == "Government":
+                expired_count = int(expiration_index.get(supplier_id, 0)) if supplier_id is not None else 0
+                if expired_count > 0:
+                    factors["expiration_factor"] = -min(15, expired_count * 5)
             # Factor 6: Distance from source (new)
             if supplier_location and source_location:
-                distance = calculate_distance(source_location, supplier_location)
-                # Scale: 0-5000km: 10 points, 5000-10000km: 5 points, >10000km: 0 points
-                if distance is not None:
-                    if distance < 5000:
-                        factors["distance_factor"] = 10
-                    elif distance < 10000:
-                        factors["distance_factor"] = 5
-                    else:
-                        factors["distance_factor"] = 0
-                else:
-                    # Penalize if distance calculation failed
-                    factors["distance_factor"] = -5
+                source_coords = remote["coordinates"].get(source_location)
+                dest_coords = remote["coordinates"].get(supplier_location)
+                distance = haversine_distance(source_coords, dest_coords) if source_coords and dest_coords else None
+                factors["distance_factor"] = distance_factor_for(distance)
             else:
                 # Penalize for missing location data
                 factors["distance_factor"] = -5
+            # Factor 7: Customer feedback ratings
+            factors["feedback_factor"] = feedback_factors.get(supplier_name, 0.0)
             # Calculate final score (clamped between 0-100)
-            # Add randomness to break ties (0-2 points)
-            import random
-            randomness = random.uniform(0, 2)
-            final_score = base_score + sum(factors.values()) + randomness
+            # Deterministic 0-2 point tie-break
+            tie_break = tie_break_for(domain, supplier_id, supplier_name, product_category, product_name)
+            final_score = base_score + sum(factors.values()) + tie_break
             final_score = max(0, min(100, final_score))
             # Add to scores list
             scores.append({
@@ -386,7 +1405,437 @@ def calculate_supplier_scores(supplier_list, csv_data, product_category, product
     # Sort by score (descending)
     scores.sort(key=lambda x: x["score"], reverse=True)
     return scores
-def generate_recommendation_explanation(top_suppliers, product_info):
+# Category as scored and cached: surrounding and repeated whitespace removed, case kept
+def normalize_category(product_category):
+    return " ".join(str(product_category).split())
+# Tie-break of 0-2 points from a stable hash of the supplier and the query, so the
+# same query always ranks equally scored suppliers the same way
+def tie_break_for(domain, supplier_id, supplier_name, product_category, product_name):
+    text = "|".join(" ".join(str(part).lower().split())
+                    for part in (product_category, product_name, domain, supplier_id, supplier_name))
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64 * 2
+# Factor values derived from remote lookups
+def weather_factor_for(weather_data):
+    if weather_data and weather_data.get("has_extreme_weather"):
+        extreme_days = weather_data.get("extreme_weather_days", 0)
+        return -min(15, extreme_days * 3)
+    return 5
+def tariff_factor_for(high_tariff):
+    if high_tariff is None:
+        return 0  # Neutral if no tariff data
+    return -10 if high_tariff else 5
+def distance_factor_for(distance):
+    # Scale: 0-5000km: 10 points, 5000-10000km: 5 points, >10000km: 0 points
+    if distance is None:
+        return -5  # Penalize if distance calculation failed
+    if distance < 5000:
+        return 10
+    if distance < 10000:
+        return 5
+    return 0
+# Pick the first truthy value across columns, mirroring chained supplier.get(...) or ... lookups
+def _first_truthy(df, columns):
+    result = pd.Series([None] * len(df), index=df.index, dtype=object)
+    for column in reversed(columns):
+        if column not in df.columns:
+            continue
+        values = df[column].astype(object)
+        if column == columns[-1]:
+            result = values
+        else:
+            truthy = values.to_numpy(dtype=object).astype(bool)
+            result = values.where(truthy, result)
+    return result
+# Build one normalized frame from the per-domain supplier frames
+def build_supplier_frame(supplier_list):
+    frames = []
+    for suppliers_df in supplier_list:
+        if suppliers_df.empty:
+            continue
+        frame = pd.DataFrame(index=suppliers_df.index)
+        frame["supplier_id"] = suppliers_df["ID"].astype(object) if "ID" in suppliers_df.columns else None
+        frame["supplier_name"] = suppliers_df["Name"].astype(object) if "Name" in suppliers_df.columns else "Unknown"
+        frame["domain"] = suppliers_df["domain"].astype(object) if "domain" in suppliers_df.columns else "Unknown"
+        frame["city"] = _first_truthy(suppliers_df, ["City", "city"])
+        frame["country"] = _first_truthy(suppliers_df, ["Country", "country", "State", "state"])
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=["supplier_id", "supplier_name", "domain", "city", "country", "location", "city_status"])
+    suppliers = pd.concat(frames, ignore_index=True)
+    # Handle missing location data
+    suppliers["city"] = suppliers["city"].where(suppliers["city"].notna(), None)
+    suppliers["country"] = suppliers["country"].where(suppliers["country"].notna(), "United States")
+    # Classify cities: "valid", "company" (looks like a company name) or "missing"
+    stripped = suppliers["city"].str.strip()
+    has_city = stripped.notna() & (stripped.str.len() > 0)
+    company_pattern = "|".join(re.escape(term) for term in company_terms)
+    looks_like_company = suppliers["city"].str.lower().str.contains(company_pattern, regex=True).fillna(False).astype(bool)
+    valid = has_city & ~looks_like_company
+    suppliers["city_status"] = np.where(valid, "valid", np.where(has_city, "company", "missing"))
+    country_truthy = suppliers["country"].to_numpy(dtype=object).astype(bool)
+    city = suppliers["city"].where(valid, "")
+    location = city.where(~country_truthy, city + ", " + suppliers["country"].astype(str))
+    suppliers["location"] = location.where(valid, None)
+    return suppliers
+# SGE expiry dates parsed once per products frame; expired counts per supplier are
+# recomputed from them only when the reference day rolls over
+_expiration_index = {"frame": None, "rows": 0, "codes": None, "suppliers": None, "dates": None, "day": None,
+                     "counts": None}
+def get_expiration_index(csv_data, reference_time=None):
+    """Expired SGE product count per supplier ID"""
+    if "sge_products" not in csv_data or "Expire Date" not in csv_data["sge_products"].columns:
+        return pd.Series(dtype=int)
+    sge_products = csv_data["sge_products"]
+    index = _expiration_index
+    if index["frame"] is not sge_products or index["rows"] != len(sge_products):
+        codes, suppliers = pd.factorize(sge_products["Supplier ID"])
+        index.update({
+            "frame": sge_products,
+            "rows": len(sge_products),
+            "codes": codes,
+            "suppliers": suppliers,
+            "dates": pd.to_datetime(sge_products["Expire Date"], format="%Y-%m-%d", errors="coerce").to_numpy(),
+            "day": None
+        })
+    # A product expires once its date is before now, i.e. on or before the reference day
+    day = (reference_time or datetime.now()).date()
+    if index["day"] != day:
+        cutoff = np.datetime64(day) + np.timedelta64(1, "D")
+        expired = (index["dates"] < cutoff) & (index["codes"] >= 0)
+        counts = np.bincount(index["codes"][expired], minlength=len(index["suppliers"]))
+        index["counts"] = pd.Series(counts, index=index["suppliers"])
+        index["day"] = day
+    return index["counts"]
+# Factor columns, in the order they appear in each score's "factors" breakdown
+factor_columns = ["complaint_factor", "weather_factor", "tariff_factor", "product_match_factor",
+                  "expiration_factor", "distance_factor", "feedback_factor"]
+# Best possible value of each factor that needs a remote lookup
+remote_factor_max = {"weather_factor": 5, "tariff_factor": 5, "distance_factor": 10}
+# Read-only lookup tables behind the supplier-level factors
+def supplier_factor_tables(csv_data):
+    return {
+        "complaints": get_supplier_complaint_index(csv_data),
+        "expiration": get_expiration_index(csv_data),
+        "feedback": get_feedback_factors()
+    }
+# Add the product-independent complaint and expiration factors as columns
+def _add_supplier_factors(suppliers, csv_data, tables=None):
+    if tables is None:
+        tables = supplier_factor_tables(csv_data)
+    # Factor 1: Complaints
+    complaint_table = pd.DataFrame.from_dict(tables["complaints"], orient="index",
+                                             columns=["complaint_count", "complaint_severity"])
+    complaint_count = suppliers["supplier_name"].map(complaint_table["complaint_count"]).fillna(0).astype(int)
+    complaint_severity = suppliers["supplier_name"].map(complaint_table["complaint_severity"]).fillna(0)
+    suppliers["complaint_count"] = complaint_count
+    suppliers["complaint_load"] = complaint_count * complaint_severity / 10
+    suppliers["complaint_factor"] = np.where(complaint_count == 0, 10, -np.minimum(20, suppliers["complaint_load"]))
+    # Factor 5: Expired products (SGE specific)
+    expired_count = suppliers["supplier_id"].map(tables["expiration"]).fillna(0)
+    expired_count = expired_count.where(suppliers["domain"] == "Government", 0)
+    suppliers["expiration_factor"] = np.where(expired_count > 0, -np.minimum(15, expired_count * 5), 0)
+    # Factor 7: Customer feedback ratings
+    suppliers["feedback_factor"] = suppliers["supplier_name"].map(tables["feedback"]).fillna(0.0).astype(float)
+    suppliers["wto_code"] = suppliers["country"].map(wto_country_codes).fillna("C840")
+    return suppliers
+# Add the query-dependent product match factor and the tie-break as columns
+def _add_query_factors(suppliers, product_category, product_name):
+    # Factor 4: Product category match
+    suppliers["product_match_factor"] = np.where(suppliers["domain"].str.lower() == product_category.lower(), 15, -5)
+    # Deterministic 0-2 point tie-break
+    suppliers["tie_break"] = [
+        tie_break_for(domain, supplier_id, supplier_name, product_category, product_name)
+        for domain, supplier_id, supplier_name in zip(suppliers["domain"], suppliers["supplier_id"],
+                                                      suppliers["supplier_name"])
+    ]
+    return suppliers
+def _add_local_factors(suppliers, csv_data, product_category, product_name):
+    return _add_query_factors(_add_supplier_factors(suppliers, csv_data), product_category, product_name)
+# Add weather, tariff and distance factors from prefetched remote lookups
+def _add_remote_factors(suppliers, remote, source_location):
+    locations = suppliers["location"].dropna().unique()
+    # Factor 2: Weather risks
+    # Locations the background refresher hasn't published yet are neutral
+    weather_factors = {location: weather_factor_for(remote["weather"][location]) if location in remote["weather"] else 0
+                       for location in locations}
+    weather_factor = pd.Series(np.where(suppliers["city_status"] == "company", 0, -5), index=suppliers.index)
+    suppliers["weather_factor"] = suppliers["location"].map(weather_factors).fillna(weather_factor)
+    # Factor 3: Tariffs
+    suppliers["tariff_factor"] = suppliers["wto_code"].map(
+        {code: tariff_factor_for(flag) for code, flag in remote["tariffs"].items()})
+    # Factor 6: Distance from source, one NumPy pass over the distinct located destinations
+    distance_factors = {}
+    source_coords = remote["coordinates"].get(source_location) if source_location else None
+    located = [location for location in locations if remote["coordinates"].get(location)]
+    if source_coords and located:
+        coords = np.array([remote["coordinates"][location] for location in located], dtype=float)
+        distances = haversine_distances(source_coords, coords[:, 0], coords[:, 1])
+        distance_factors = dict(zip(located, distance_factors_for(distances).tolist()))
+    suppliers["distance_factor"] = suppliers["location"].map(distance_factors).fillna(-5)
+    return suppliers
+def _prefetch_for(suppliers, product_hs, source_location):
+    locations = suppliers["location"].dropna().unique()
+    print(f"Fetching remote data for {len(locations)} locations")
+    return prefetch_remote_data(locations, suppliers["wto_code"].unique(), product_hs, source_location)
+# Final score clamped between 0-100
+def _final_scores(suppliers):
+    base_score = 50
+    return np.clip(base_score + suppliers[factor_columns].sum(axis=1) + suppliers["tie_break"], 0, 100)
+# Score dicts sorted by score, ties kept in catalog order
+def _score_records(suppliers):
+    scores = _supplier_records(suppliers.sort_index())
+    scores.sort(key=lambda x: x["score"], reverse=True)
+    return scores
+# Score dicts in frame order
+def _supplier_records(suppliers):
+    scores = []
+    for row, score in zip(suppliers.itertuples(index=False), _final_scores(suppliers)):
+        scores.append({
+            "supplier_id": row.supplier_id,
+            "supplier_name": row.supplier_name,
+            "domain": row.domain,
+            "score": float(score),
+            "factors": {
+                "complaint_factor": 10 if row.complaint_count == 0 else -min(20, float(row.complaint_load)),
+                "weather_factor": int(row.weather_factor),
+                "tariff_factor": int(row.tariff_factor),
+                "product_match_factor": int(row.product_match_factor),
+                "expiration_factor": int(row.expiration_factor),
+                "distance_factor": int(row.distance_factor),
+                "feedback_factor": float(row.feedback_factor)
+            },
+            "city": row.city,
+            "country": row.country,
+            "complaint_count": int(row.complaint_count),
+            "location": row.location
+        })
+    return scores
+# Columnar equivalent of calculate_supplier_scores
+def calculate_supplier_scores_vectorized(supplier_list, csv_data, product_category, product_name, source_location,
+                                         progress_callback=None):
+    _report_progress(progress_callback, "hs_code")
+    product_hs = get_hs_code_for_product(product_name, product_category)
+    suppliers = build_supplier_frame(supplier_list)
+    if suppliers.empty:
+        return []
+    suppliers = _add_local_factors(suppliers, csv_data, product_category, product_name)
+    # Remote lookups: each distinct location and WTO reporter is fetched once, concurrently
+    _report_progress(progress_callback, "remote_lookups")
+    remote = _prefetch_for(suppliers, product_hs, source_location)
+    _report_progress(progress_callback, "scoring")
+    suppliers = _add_remote_factors(suppliers, remote, source_location)
+    return _score_records(suppliers)
+# Upper bound on each supplier's final score before any remote lookup
+def _score_upper_bounds(suppliers, source_location):
+    base_score = 50
+    local = suppliers[["complaint_factor", "product_match_factor", "expiration_factor", "feedback_factor",
+                       "tie_break"]].sum(axis=1)
+    valid = suppliers["city_status"] == "valid"
+    weather_max = np.where(valid, remote_factor_max["weather_factor"],
+                           np.where(suppliers["city_status"] == "company", 0, -5))
+    distance_max = np.where(valid & bool(source_location), remote_factor_max["distance_factor"], -5)
+    upper_bound = base_score + local + weather_max + remote_factor_max["tariff_factor"] + distance_max
+    return np.clip(upper_bound.to_numpy(dtype=float), 0, 100)
+# Top-k scoring that resolves remote factors in descending upper-bound order
+# and stops once no remaining supplier can beat the current k-th score
+def calculate_supplier_scores_topk(supplier_list, csv_data, product_category, product_name, source_location,
+                                   k=5, batch_size=64, progress_callback=None):
+    _report_progress(progress_callback, "hs_code")
+    product_hs = get_hs_code_for_product(product_name, product_category)
+    suppliers = build_supplier_frame(supplier_list)
+    if suppliers.empty or k <= 0:
+        return []
+    suppliers = _add_local_factors(suppliers, csv_data, product_category, product_name)
+    upper_bound = _score_upper_bounds(suppliers, source_location)
+    order = np.argsort(-upper_bound, kind="stable")
+    _report_progress(progress_callback, "remote_lookups")
+    best = []  # Min-heap of the k best final scores so far
+    resolved = []
+    for start in range(0, len(order), batch_size):
+        kth_score = best[0] if len(best) >= k else -np.inf
+        positions = order[start:start + batch_size]
+        positions = positions[upper_bound[positions] >= kth_score]
+        if len(positions) == 0:
+            break
+        batch = suppliers.iloc[positions].copy()
+        remote = _prefetch_for(batch, product_hs, source_location)
+        batch = _add_remote_factors(batch, remote, source_location)
+        for score in _final_scores(batch):
+            if len(best) < k:
+                heapq.heappush(best, score)
+            elif score > best[0]:
+                heapq.heapreplace(best, score)
+        resolved.append(batch)
+    print(f"Resolved remote factors for {sum(len(batch) for batch in resolved)} of {len(suppliers)} suppliers")
+    _report_progress(progress_callback, "scoring")
+    return _score_records(pd.concat(resolved))[:k]
+# Parallel scoring settings. Shards are scored in a persistent process pool; each call ships the
+# supplier frame and lookup tables to the workers once through a shared memory segment
+parallel_workers = os.cpu_count() or 1
+parallel_shard_rows = 5000
+parallel_start_method = "spawn"  # Safe alongside the HTTP and refresher threads
+_scoring_pool = {"executor": None, "workers": 0, "lock": threading.Lock()}
+_shard_payload = {"segment": None, "payload": None, "positions": None}
+def _get_scoring_pool(workers):
+    with _scoring_pool["lock"]:
+        if _scoring_pool["executor"] is None or _scoring_pool["workers"] != workers:
+            if _scoring_pool["executor"] is not None:
+                _scoring_pool["executor"].shutdown()
+            context = multiprocessing.get_context(parallel_start_method)
+            _scoring_pool.update({"executor": ProcessPoolExecutor(max_workers=workers, mp_context=context),
+                                  "workers": workers})
+        return _scoring_pool["executor"]
+def shutdown_scoring_pool():
+    with _scoring_pool["lock"]:
+        if _scoring_pool["executor"] is not None:
+            _scoring_pool["executor"].shutdown()
+        _scoring_pool.update({"executor": None, "workers": 0})
+# Row positions per domain, in catalog order
+def _domain_positions(suppliers):
+    return {domain: positions for domain, positions in suppliers.groupby("domain", sort=False).indices.items()}
+# Worker side: unpickle the call's payload once per process, then score one shard of it
+def _score_shard(segment_name, size, domain, start, stop):
+    if _shard_payload["segment"] != segment_name:
+        segment = shared_memory.SharedMemory(name=segment_name)
+        try:
+            payload = pickle.loads(segment.buf[:size])
+        finally:
+            segment.close()
+        _shard_payload.update({"segment": segment_name, "payload": payload,
+                               "positions": _domain_positions(payload["suppliers"])})
+    payload = _shard_payload["payload"]
+    positions = _shard_payload["positions"][domain][start:stop]
+    product_category, product_name, source_location = payload["query"]
+    shard = payload["suppliers"].iloc[positions].copy()
+    shard = _add_supplier_factors(shard, None, payload["tables"])
+    shard = _add_query_factors(shard, product_category, product_name)
+    shard = _add_remote_factors(shard, payload["remote"], source_location)
+    ranked = sorted(zip(positions.tolist(), _supplier_records(shard)), key=lambda item: (-item[1]["score"], item[0]))
+    return ranked[:payload["k"]] if payload["k"] else ranked
+# Multi-process equivalent of calculate_supplier_scores_vectorized, optionally cut to the top k
+def calculate_supplier_scores_parallel(supplier_list, csv_data, product_category, product_name, source_location,
+                                       k=None, workers=None, progress_callback=None):
+    _report_progress(progress_callback, "hs_code")
+    product_hs = get_hs_code_for_product(product_name, product_category)
+    suppliers = build_supplier_frame(supplier_list)
+    if suppliers.empty:
+        return []
+    tables = supplier_factor_tables(csv_data)
+    suppliers["wto_code"] = suppliers["country"].map(wto_country_codes).fillna("C840")
+    _report_progress(progress_callback, "remote_lookups")
+    remote = _prefetch_for(suppliers, product_hs, source_location)
+    # Workers only need the two weather fields the factor reads, not whole forecasts
+    remote = dict(remote, weather={
+        location: {key: data[key] for key in ("has_extreme_weather", "extreme_weather_days") if key in data}
+        if data else data
+        for location, data in remote["weather"].items()
+    })
+    _report_progress(progress_callback, "scoring")
+    shard_rows = parallel_shard_rows
+    shards = [(domain, start, start + shard_rows) for domain, positions in _domain_positions(suppliers).items()
+              for start in range(0, len(positions), shard_rows)]
+    payload = pickle.dumps({
+        "suppliers": suppliers.drop(columns=["wto_code"]),
+        "tables": tables,
+        "remote": remote,
+        "query": (product_category, product_name, source_location),
+        "k": k
+    }, protocol=pickle.HIGHEST_PROTOCOL)
+    segment = shared_memory.SharedMemory(create=True, size=len(payload))
+    try:
+        segment.buf[:len(payload)] = payload
+        with timed("parallel_scoring", shards=len(shards)):
+            executor = _get_scoring_pool(workers or parallel_workers)
+            futures = [executor.submit(_score_shard, segment.name, len(payload), *shard) for shard in shards]
+            ranked = [item for future in futures for item in future.result()]
+    finally:
+        segment.close()
+        segment.unlink()
+    # Merge the partial rankings: score descending, ties in catalog order
+    ranked.sort(key=lambda item: (-item[1]["score"], item[0]))
+    scores = [record for _, record in ranked]
+    return scores[:k] if k else scores
+# Materialized score tables for incremental re-scoring, one per query. Each keeps every supplier
+# row's score dict with a fingerprint of its inputs, so a rescore only recomputes rows that were
+# added or whose supplier fields, complaints, expired products or feedback changed, plus rows scored
+# with neutral weather once the background refresher has published more forecasts
+score_table_ttl = 3600  # Rebuild a table from scratch once its weather and tariff factors may be stale
+score_table_limit = 32
+_score_tables = {}
+_score_tables_lock = threading.Lock()
+_fingerprint_columns = ["supplier_id", "supplier_name", "domain", "city", "country", "complaint_count",
+                        "complaint_load", "expiration_factor", "feedback_factor"]
+# Stable row keys: domain and supplier ID, numbered when an ID repeats within a domain
+def _row_keys(suppliers):
+    ids = suppliers["domain"].astype(str) + "|" + suppliers["supplier_id"].astype(str)
+    occurrence = ids.groupby(ids, sort=False).cumcount().astype(str)
+    return (ids + "|" + occurrence).tolist()
+def _row_fingerprints(suppliers):
+    return pd.util.hash_pandas_object(suppliers[_fingerprint_columns].astype(str), index=False).tolist()
+def _get_score_table(table_key, query):
+    with _score_tables_lock:
+        table = _score_tables.pop(table_key, None)
+        if table is None or time.time() - table["built_at"] > score_table_ttl:
+            table = {"query": query, "rows": {}, "built_at": time.time(), "lock": threading.Lock()}
+        # Re-insert so dict order stays least to most recently used
+        _score_tables[table_key] = table
+        while len(_score_tables) > score_table_limit:
+            del _score_tables[next(iter(_score_tables))]
+    return table
+# Same result as calculate_supplier_scores_vectorized, recomputing only suppliers whose inputs
+# changed since the last call for this query
+def calculate_supplier_scores_incremental(supplier_list, csv_data, product_category, product_name, source_location,
+                                          progress_callback=None):
+    # Rows are shared by every spelling of the category that maps to this table, so score the shared form
+    product_category = normalize_category(product_category)
+    _report_progress(progress_callback, "hs_code")
+    product_hs = get_hs_code_for_product(product_name, product_category)
+    suppliers = build_supplier_frame(supplier_list)
+    if suppliers.empty:
+        return []
+    suppliers = _add_supplier_factors(suppliers, csv_data)
+    keys = _row_keys(suppliers)
+    fingerprints = _row_fingerprints(suppliers)
+    table_key = (product_category.lower(), " ".join(str(product_name).lower().split()), product_hs,
+                 normalize_location(source_location) if source_location else "")
+    table = _get_score_table(table_key, (product_category, product_name, source_location))
+    weather_version = _weather_refresher["version"]
+    with table["lock"]:
+        rows = table["rows"]
+        # Rows hold (fingerprint, record, weather version if scored without a published forecast)
+        affected = [position for position, (key, fingerprint) in enumerate(zip(keys, fingerprints))
+                    if key not in rows or rows[key][0] != fingerprint
+                    or rows[key][2] not in (None, weather_version)]
+        added = sum(1 for position in affected if keys[position] not in rows)
+        current = set(keys)
+        removed = [key for key in rows if key not in current]
+        for key in removed:
+            del rows[key]
+        _report_progress(progress_callback, "remote_lookups")
+        if affected:
+            batch = _add_query_factors(suppliers.iloc[affected].copy(), product_category, product_name)
+            remote = _prefetch_for(batch, product_hs, source_location)
+            batch = _add_remote_factors(batch, remote, source_location)
+            unpublished = (batch["location"].notna() & ~batch["location"].isin(list(remote["weather"]))).tolist()
+            for position, record, pending in zip(affected, _supplier_records(batch), unpublished):
+                rows[keys[position]] = (fingerprints[position], record, weather_version if pending else None)
+        print(f"Rescored {len(affected)} of {len(keys)} suppliers "
+              f"({added} new, {len(affected) - added} changed, {len(removed)} removed)")
+        _report_progress(progress_callback, "scoring")
+        scores = [dict(rows[key][1], factors=dict(rows[key][1]["factors"])) for key in keys]
+    # Stable sort over catalog order, so ties rank as in a full rescore
+    scores.sort(key=lambda x: x["score"], reverse=True)
+    return scores
+# Bring every materialized score table up to date with newly loaded data, e.g. after a nightly reload
+def refresh_score_tables(csv_data):
+    supplier_list = extract_supplier_features(csv_data)
+    with _score_tables_lock:
+        queries = [table["query"] for table in _score_tables.values()]
+    for query in queries:
+        calculate_supplier_scores_incremental(supplier_list, csv_data, *query)
+    return len(queries)
+def generate_recommendation_explanation(top_suppliers, product_info, stream=False):
     context = f"""
     Product Category: {product_info['category']}
     Product Name: {product_info['name']}
@@ -404,7 +1853,8 @@ def generate_recommendation_explanation(top_suppliers, product_info):
                      Product Match ({supplier['factors']['product_match_factor']}),
                      Expiration ({supplier['factors']['expiration_factor']}),
                      Complaints ({supplier['factors']['complaint_factor']}),
-                     Distance ({supplier['factors']['distance_factor']})
+                     Distance ({supplier['factors']['distance_factor']}),
+                     Customer Feedback ({supplier['factors'].get('feedback_factor', 0)})
         """
     prompt = f"""
     You are an expert procurement AI assistant. Based on the following information about recommended suppliers for a product,
@@ -413,23 +1863,29 @@ def generate_recommendation_explanation(top_suppliers, product_info):
     2. Any potential risks or concerns
     3. Overall assessment of the top recommendation
     4. Distance considerations from the client location to the supplier
-    Make sure to reference specific factors like complaint history, tariffs, weather risks, product matching, and geographical distance.
+    Make sure to reference specific factors like complaint history, tariffs, weather risks, product matching, customer feedback and geographical distance.
     {context}
     Provide your explanation in a structured format with clear reasoning for each recommendation.
     """
-    response = client.text_generation(
-        prompt,
-        max_new_tokens=2048,
-        temperature=0.7,
-        repetition_penalty=1.1,
-        top_p=0.9
-    )
+    # With stream=True this returns an iterator of text chunks as they are generated
+    count("llm_requests", host="huggingface")
+    with timed("explanation"), timed("llm_request", host="huggingface"):
+        response = get_llm_client().text_generation(
+            prompt,
+            max_new_tokens=2048,
+            temperature=0.7,
+            repetition_penalty=1.1,
+            top_p=0.9,
+            stream=stream
+        )
+    if stream:
+        return _timed_stream(response, "explanation_stream", host="huggingface")
     return response
 def get_user_location():
     """Get the user's location based on IP address"""
     try:
         # Use ipinfo.io to get location information
-        response = requests.get("https://ipinfo.io/json")
+        response = http_get(ipinfo_url)
         if response.status_code == 200:
             data = response.json()
             city = data.get("city")
@@ -443,64 +1899,795 @@ def get_user_location():
     city = input("Please enter your city: ")
     country = input("Please enter your country: ")
     return f"{city}, {country}"
+# Geocoding cache settings
+geocode_cache_path = "geocode_cache.sqlite"  # Set to None to keep geocodes in memory only
+geocode_negative_ttl = 30 * 24 * 3600  # Retry unresolvable locations after 30 days
+_geocode_memo = {}  # Normalized location -> (coords, checked_at); coords is None when unresolvable
+_geocode_inflight = {}  # Normalized location -> Event set when the lookup already running for it finishes
+_geocode_lock = threading.Lock()
+def _open_geocode_db():
+    conn = sqlite3.connect(geocode_cache_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS geocodes ("
+        "location TEXT PRIMARY KEY, lat REAL, lon REAL, resolved INTEGER NOT NULL, updated_at REAL NOT NULL)"
+    )
+    return conn
+# Read cached (coords, checked_at) for normalized location keys, skipping expired negative entries
+def _read_geocodes(keys):
+    if not geocode_cache_path or not keys:
+        return {}
+    found = {}
+    conn = _open_geocode_db()
+    try:
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT location, lat, lon, resolved, updated_at FROM geocodes WHERE location IN ({placeholders})", chunk
+            ).fetchall()
+            for location, lat, lon, resolved, updated_at in rows:
+                if resolved:
+                    found[location] = ((lat, lon), updated_at)
+                elif time.time() - updated_at < geocode_negative_ttl:
+                    found[location] = (None, updated_at)
+    finally:
+        conn.close()
+    return found
+def _write_geocodes(entries):
+    if not geocode_cache_path or not entries:
+        return
+    now = time.time()
+    rows = [(key, coords[0] if coords else None, coords[1] if coords else None, 1 if coords else 0, now)
+            for key, coords in entries.items()]
+    conn = _open_geocode_db()
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)", rows)
+    finally:
+        conn.close()
+# Query Nominatim for one location; returns (coords, cacheable)
+def _fetch_coordinates(location):
+    try:
+        url = f"{nominatim_url}?q={location}&format=json"
+        headers = {"User-Agent": "SupplierRecommendationSystem/1.0"}
+        response = http_get(url, headers=headers)
+        if response.status_code == 200:
+            data = response.json()
+            if data:
+                return (float(data[0]["lat"]), float(data[0]["lon"])), True
+            # Nominatim answered but found nothing: remember that
+            return None, True
+    except Exception as e:
+        print(f"Error getting coordinates for {location}: {str(e)}")
+    return None, False
+# Memo entries stay valid forever once resolved, and for geocode_negative_ttl when unresolvable
+def _geocode_fresh(entry, now):
+    return entry is not None and (entry[0] is not None or now - entry[1] < geocode_negative_ttl)
+# Resolve many locations to (lat, lon), geocoding each distinct location at most once
+def resolve_locations(locations):
+    keys = {}
+    for location in locations:
+        if isinstance(location, str) and location.strip():
+            keys.setdefault(normalize_location(location), location.strip())
+    now = time.time()
+    with _geocode_lock:
+        missing = [key for key in keys if not _geocode_fresh(_geocode_memo.get(key), now)]
+    to_fetch = []
+    if missing:
+        stored = _read_geocodes(missing)
+        with _geocode_lock:
+            _geocode_memo.update(stored)
+            # Locations another request is already geocoding are waited for, not fetched again
+            waiting = [_geocode_inflight[key] for key in missing if key not in stored and key in _geocode_inflight]
+            to_fetch = [key for key in missing if key not in stored and key not in _geocode_inflight]
+            for key in to_fetch:
+                _geocode_inflight[key] = threading.Event()
+        fetched = {}
+        try:
+            if to_fetch:
+                with timed("geocode_lookup"), ThreadPoolExecutor(max_workers=prefetch_workers) as pool:
+                    results = pool.map(_with_context(lambda key: _fetch_coordinates(keys[key])), to_fetch)
+                    for key, (coords, cacheable) in zip(to_fetch, results):
+                        if cacheable:
+                            fetched[key] = (coords, time.time())
+        finally:
+            with _geocode_lock:
+                _geocode_memo.update(fetched)
+                for key in to_fetch:
+                    _geocode_inflight.pop(key).set()
+        _write_geocodes({key: coords for key, (coords, _) in fetched.items()})
+        for event in waiting:
+            event.wait()
+    count("cache_hits", amount=len(keys) - len(to_fetch), cache="geocode")
+    count("cache_misses", amount=len(to_fetch), cache="geocode")
+    with _geocode_lock:
+        entries = {key: _geocode_memo.get(key) for key in keys}
+    return {
+        location: (entries[normalize_location(location)] or (None, 0))[0]
+        if isinstance(location, str) and location.strip() else None
+        for location in locations
+    }
+def get_coordinates(location):
+    return resolve_locations([location])[location]
+# Great-circle distance in kilometers between two (lat, lon) pairs
+def haversine_distance(source_coords, dest_coords):
+    R = 6371  # Earth radius in kilometers
+    lat1, lon1 = radians(source_coords[0]), radians(source_coords[1])
+    lat2, lon2 = radians(dest_coords[0]), radians(dest_coords[1])
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * atan2(sqrt(a), sqrt(1-a))
+    return R * c
 def calculate_distance(source, destination):
-    """Calculate the distance between two locations using the Distance Matrix API"""
+    """Calculate the distance between two locations using cached Nominatim geocodes"""
     try:
-        # Use the Nominatim API to get coordinates
-        import requests
-        def get_coordinates(location):
-            try:
-                url = f"https://nominatim.openstreetmap.org/search?q={location}&format=json"
-                headers = {"User-Agent": "SupplierRecommendationSystem/1.0"}
-                response = requests.get(url, headers=headers)
-                if response.status_code == 200:
-                    data = response.json()
-                    if data:
-                        return float(data[0]["lat"]), float(data[0]["lon"])
-            except Exception as e:
-                print(f"Error getting coordinates for {location}: {str(e)}")
-            return None
-        # Get coordinates for source and destination
-        source_coords = get_coordinates(source)
-        dest_coords = get_coordinates(destination)
+        coordinates = resolve_locations([source, destination])
+        source_coords = coordinates[source]
+        dest_coords = coordinates[destination]
         if source_coords and dest_coords:
-            from math import radians, sin, cos, sqrt, atan2
-            # Haversine formula to calculate distance
-            R = 6371  # Earth radius in kilometers
-            lat1, lon1 = radians(source_coords[0]), radians(source_coords[1])
-            lat2, lon2 = radians(dest_coords[0]), radians(dest_coords[1])
-            dlon = lon2 - lon1
-            dlat = lat2 - lat1
-            a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-            c = 2 * atan2(sqrt(a), sqrt(1-a))
-            distance = R * c
-            return distance
+            return haversine_distance(source_coords, dest_coords)
     except Exception as e:
         print(f"Error calculating distance: {str(e)}")
     return None
-def recommend_suppliers(product_category, product_name, source_location=None, csv_data=None):
+# Great-circle distances in kilometers from one (lat, lon) pair to arrays of latitudes and longitudes
+def haversine_distances(source_coords, lats, lons):
+    R = 6371  # Earth radius in kilometers
+    lat1, lon1 = np.radians(source_coords[0]), np.radians(source_coords[1])
+    lat2, lon2 = np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+# distance_factor_for over an array of distances
+def distance_factors_for(distances):
+    return np.select([distances < 5000, distances < 10000], [10, 5], 0)
+# Lat/lon grid over located points, for radius and nearest-N queries without scanning every point
+spatial_cell_degrees = 2.0
+km_per_degree = 6371 * np.pi / 180
+def build_spatial_index(coordinates):
+    """Grid index over {location: (lat, lon)}; unresolved locations are skipped"""
+    located = [(location, coords) for location, coords in coordinates.items() if coords]
+    lats = np.array([coords[0] for _, coords in located], dtype=float)
+    lons = np.array([coords[1] for _, coords in located], dtype=float)
+    rows, columns = _grid_cells(lats, lons)
+    cells = {}
+    for position, cell in enumerate(zip(rows.tolist(), columns.tolist())):
+        cells.setdefault(cell, []).append(position)
+    return {
+        "locations": [location for location, _ in located],
+        "lats": lats,
+        "lons": lons,
+        "cells": {cell: np.array(positions) for cell, positions in cells.items()}
+    }
+def _grid_cells(lats, lons):
+    rows = np.floor((np.clip(lats, -90, 90) + 90) / spatial_cell_degrees).astype(int)
+    columns = np.floor(((lons + 180) % 360) / spatial_cell_degrees).astype(int)
+    return rows, columns
+# Positions of points in the grid cells that can hold points within radius_km of center
+def _cells_near(index, center, radius_km):
+    column_count = int(np.ceil(360 / spatial_cell_degrees))
+    lat_span = radius_km / km_per_degree
+    low_lat, high_lat = center[0] - lat_span, center[0] + lat_span
+    if low_lat <= -90 or high_lat >= 90:
+        columns = range(column_count)  # The circle reaches a pole, so every longitude is in range
+    else:
+        # Longitude degrees shrink with latitude, so widen the span at the band's poleward edge
+        lon_span = lat_span / np.cos(np.radians(max(abs(low_lat), abs(high_lat))))
+        if lon_span >= 180:
+            columns = range(column_count)
+        else:
+            first = int(np.floor(((center[1] - lon_span + 180) % 360) / spatial_cell_degrees))
+            width = int(np.ceil(2 * lon_span / spatial_cell_degrees)) + 1
+            columns = [(first + offset) % column_count for offset in range(min(width, column_count))]
+    first_row, last_row = _grid_cells(np.array([max(low_lat, -90), min(high_lat, 90)]), np.zeros(2))[0]
+    found = [index["cells"][(row, column)] for row in range(first_row, last_row + 1) for column in columns
+             if (row, column) in index["cells"]]
+    return np.concatenate(found) if found else np.array([], dtype=int)
+def locations_within(index, center, radius_km):
+    """[(location, distance_km)] within radius_km of center, nearest first"""
+    positions = _cells_near(index, center, radius_km)
+    distances = haversine_distances(center, index["lats"][positions], index["lons"][positions])
+    keep = distances <= radius_km
+    positions, distances = positions[keep], distances[keep]
+    order = np.argsort(distances, kind="stable")
+    return [(index["locations"][position], float(distance))
+            for position, distance in zip(positions[order], distances[order])]
+def nearest_locations(index, center, n):
+    """The n located points nearest to center as [(location, distance_km)]"""
+    n = min(n, len(index["locations"]))
+    radius_km = spatial_cell_degrees * km_per_degree
+    while n > 0:
+        found = locations_within(index, center, radius_km)
+        # Enough points inside the radius means nothing outside it can be nearer
+        if len(found) >= n or radius_km >= np.pi * 6371:
+            return found[:n]
+        radius_km *= 2
+    return []
+# Supplier-level spatial queries over the geocoded supplier locations
+_supplier_spatial_index = {"coordinates": None, "index": None}
+def get_supplier_spatial_index(suppliers):
+    coordinates = resolve_locations(suppliers["location"].dropna().unique())
+    located = {location: coords for location, coords in coordinates.items() if coords}
+    if _supplier_spatial_index["coordinates"] != located:
+        _supplier_spatial_index.update({"coordinates": located, "index": build_spatial_index(located)})
+    return _supplier_spatial_index["index"]
+def _supplier_distances(suppliers, found):
+    return suppliers.assign(distance_km=suppliers["location"].map(dict(found))).dropna(subset=["distance_km"])
+def suppliers_within(csv_data, source_location, radius_km):
+    """Suppliers located within radius_km of source_location, nearest first"""
+    suppliers = build_supplier_frame(extract_supplier_features(csv_data))
+    center = get_coordinates(source_location)
+    if center is None:
+        return suppliers.iloc[0:0].assign(distance_km=[])
+    found = locations_within(get_supplier_spatial_index(suppliers), center, radius_km)
+    return _supplier_distances(suppliers, found).sort_values("distance_km", kind="stable")
+def nearest_suppliers(csv_data, source_location, n=10):
+    """Suppliers at the n located places nearest to source_location"""
+    suppliers = build_supplier_frame(extract_supplier_features(csv_data))
+    center = get_coordinates(source_location)
+    if center is None:
+        return suppliers.iloc[0:0].assign(distance_km=[])
+    found = nearest_locations(get_supplier_spatial_index(suppliers), center, n)
+    return _supplier_distances(suppliers, found).sort_values("distance_km", kind="stable")
+# Keep only suppliers located within radius_km of source_location, as per-domain frames
+def filter_suppliers_within(supplier_list, source_location, radius_km):
+    center = get_coordinates(source_location) if source_location else None
+    if center is None:
+        print(f"Could not locate {source_location}, ignoring the distance filter")
+        return supplier_list
+    suppliers = build_supplier_frame(supplier_list)
+    nearby = {location for location, _ in locations_within(get_supplier_spatial_index(suppliers), center, radius_km)}
+    keep = suppliers["location"].isin(nearby).to_numpy()
+    filtered = []
+    start = 0
+    for suppliers_df in supplier_list:
+        filtered.append(suppliers_df[keep[start:start + len(suppliers_df)]])
+        start += len(suppliers_df)
+    print(f"{int(keep.sum())} of {len(keep)} suppliers within {radius_km} km of {source_location}")
+    return filtered
+# Recommendation result cache settings. The TTL stays below the weather and tariff cache TTLs,
+# so a cached ranking is never based on remote data older than a fresh run could see
+result_cache_size = 256
+result_cache_ttl = 600
+_result_cache = _new_cache("results")
+# Cache key of a recommendation: the query, the dataset it ran on, and the versions of the
+# local factor data (feedback, expiration day) that can change between loads
+def _result_cache_key(product_category, product_name, source_location, csv_data, top_k, radius_km):
+    return (normalize_category(product_category).lower(), " ".join(str(product_name).lower().split()),
+            normalize_location(source_location), top_k, radius_km, dataset_version(csv_data),
+            _feedback_aggregates["version"], _weather_refresher["version"], datetime.now().date().isoformat())
+def _result_cache_get(key):
+    with _result_cache["lock"]:
+        entry = _result_cache["entries"].pop(key, None)
+        if entry is not None and time.time() - entry["fetched_at"] <= result_cache_ttl:
+            # Re-insert so dict order stays least to most recently used
+            _result_cache["entries"][key] = entry
+        else:
+            entry = None
+    count("cache_misses" if entry is None else "cache_hits", cache="results")
+    return entry
+def _result_cache_put(key, top_suppliers, explanation):
+    with _result_cache["lock"]:
+        _result_cache["entries"].pop(key, None)
+        _result_cache["entries"][key] = {"top_suppliers": top_suppliers, "explanation": explanation,
+                                         "fetched_at": time.time()}
+        while len(_result_cache["entries"]) > result_cache_size:
+            del _result_cache["entries"][next(iter(_result_cache["entries"]))]
+# Pass streamed chunks through and cache the full text once the stream completes
+def _caching_stream(chunks, key, top_suppliers):
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    _result_cache_put(key, top_suppliers, "".join(parts))
+def recommend_suppliers(product_category, product_name, source_location=None, csv_data=None, vectorized=True,
+                        progress_callback=None, top_k=5, prune=True, stream_explanation=False,
+                        include_timings=False, use_cache=True, incremental=False, radius_km=None, workers=None):
+    # With include_timings, every span and counter recorded for this request (including in
+    # pool threads) is collected and returned under "timings"; see summarize_timings
+    # The result cache key and the product match factor must see the same category
+    product_category = normalize_category(product_category)
+    timings = {"spans": [], "counters": {}} if include_timings else None
+    token = _timing_collector.set(timings) if include_timings else None
+    try:
+        with timed("recommend_suppliers"):
+            result = _recommend_suppliers(product_category, product_name, source_location, csv_data, vectorized,
+                                          progress_callback, top_k, prune, stream_explanation, use_cache,
+                                          incremental, radius_km, workers)
+    finally:
+        if token is not None:
+            _timing_collector.reset(token)
+    if timings is not None:
+        result["timings"] = timings
+    if prometheus_textfile_path:
+        write_prometheus_metrics(prometheus_textfile_path)
+    return result
+def _recommend_suppliers(product_category, product_name, source_location, csv_data, vectorized, progress_callback,
+                         top_k, prune, stream_explanation, use_cache, incremental, radius_km, workers):
     if csv_data is None:
         csv_data = load_all_csvs(base_path)
     # If source location is not provided, try to determine it
     if source_location is None:
         source_location = get_user_location()
     print(f"Source location: {source_location}")
+    cache_key = (_result_cache_key(product_category, product_name, source_location, csv_data, top_k, radius_km)
+                 if use_cache else None)
+    cached = _result_cache_get(cache_key) if use_cache else None
+    if cached is not None:
+        explanation = iter([cached["explanation"]]) if stream_explanation else cached["explanation"]
+        return {"top_suppliers": copy.deepcopy(cached["top_suppliers"]), "explanation": explanation}
     supplier_list = extract_supplier_features(csv_data)
-    supplier_scores = calculate_supplier_scores(supplier_list, csv_data, product_category, product_name, source_location)
-    top_suppliers = supplier_scores[:5]
+    if radius_km is not None:
+        # Drop far-away suppliers before any scoring or remote lookups
+        supplier_list = filter_suppliers_within(supplier_list, source_location, radius_km)
+    with timed("score_suppliers"):
+        if incremental:
+            # Reuses the materialized score table of an earlier run of this query
+            top_suppliers = calculate_supplier_scores_incremental(supplier_list, csv_data, product_category, product_name,
+                                                                  source_location,
+                                                                  progress_callback=progress_callback)[:top_k]
+        elif workers:
+            # Shards of the catalog are scored in worker processes and the partial top k merged
+            top_suppliers = calculate_supplier_scores_parallel(supplier_list, csv_data, product_category, product_name,
+                                                               source_location, k=top_k, workers=workers,
+                                                               progress_callback=progress_callback)
+        elif vectorized and prune:
+            # Only the top k are shown, so skip remote lookups for suppliers that can't make the cut
+            top_suppliers = calculate_supplier_scores_topk(supplier_list, csv_data, product_category, product_name,
+                                                           source_location, k=top_k,
+                                                           progress_callback=progress_callback)
+        else:
+            score_fn = calculate_supplier_scores_vectorized if vectorized else calculate_supplier_scores
+            supplier_scores = score_fn(supplier_list, csv_data, product_category, product_name, source_location,
+                                       progress_callback=progress_callback)
+            top_suppliers = supplier_scores[:top_k]
     product_info = {
         "category": product_category,
         "name": product_name,
         "source_location": source_location
     }
-    explanation = generate_recommendation_explanation(top_suppliers, product_info)
+    _report_progress(progress_callback, "explanation")
+    # When streaming, "explanation" is an iterator of text chunks the caller consumes
+    explanation = generate_recommendation_explanation(top_suppliers, product_info, stream=stream_explanation)
+    if weather_refresher_running():
+        note_weather_demand(supplier["location"] for supplier in top_suppliers)
+    if use_cache:
+        cached_suppliers = copy.deepcopy(top_suppliers)
+        if stream_explanation:
+            explanation = _caching_stream(explanation, cache_key, cached_suppliers)
+        else:
+            _result_cache_put(cache_key, cached_suppliers, explanation)
     return {
         "top_suppliers": top_suppliers,
         "explanation": explanation
     }
+# Why a batch query can't be scored, or None when it can
+def _batch_query_error(query):
+    missing = [field for field in ("category", "product_name")
+               if not isinstance(query[field], str) or not query[field].strip()]
+    if missing:
+        return f"Missing fields: {', '.join(missing)}"
+    if query["source_location"] is not None and not isinstance(query["source_location"], str):
+        return f"source_location must be text, got {query['source_location']!r}"
+    return None
+# Recommend suppliers for many (category, product, source location) queries in one run.
+# Supplier features, weather, geocodes and tariffs are computed once and shared across
+# queries; results are yielded (and appended to output_path as JSON lines) as each query completes.
+def recommend_suppliers_batch(queries, csv_data=None, explain=False, output_path=None, top_k=5):
+    if csv_data is None:
+        csv_data = load_all_csvs(base_path)
+    queries = [
+        {
+            "category": query.get("category") or query.get("product_category"),
+            "product_name": query.get("product_name") or query.get("name"),
+            "source_location": query.get("source_location") or query.get("location")
+        }
+        for query in queries
+    ]
+    # Invalid queries get an error record in place of a result instead of stopping the batch
+    errors = [_batch_query_error(query) for query in queries]
+    for query, error in zip(queries, errors):
+        if error is None:
+            query["category"] = normalize_category(query["category"])
+    suppliers = build_supplier_frame(extract_supplier_features(csv_data))
+    suppliers = _add_supplier_factors(suppliers, csv_data)
+    hs_codes = [get_hs_code_for_product(query["product_name"], query["category"]) if error is None else None
+                for query, error in zip(queries, errors)]
+    # Every remote lookup any query needs, fetched once up front
+    locations = suppliers["location"].dropna().unique()
+    sources = list(dict.fromkeys(query["source_location"] for query, error in zip(queries, errors)
+                                 if error is None and query["source_location"]))
+    wto_codes = suppliers["wto_code"].unique()
+    print(f"Prefetching remote data for {len(locations)} locations, {len(sources)} sources and "
+          f"{len(set(hs_codes) - {None})} HS codes")
+    with timed("remote_lookups"), ThreadPoolExecutor(max_workers=3) as pool:
+        weather = pool.submit(_with_context(get_weather_forecasts), locations)
+        coordinates = pool.submit(_with_context(resolve_locations), [*sources, *locations])
+        tariffs = pool.submit(_with_context(prefetch_tariffs),
+                              [(code, hs_code) for hs_code in set(hs_codes) - {None} for code in wto_codes])
+        remote = {"weather": weather.result(), "coordinates": coordinates.result()}
+        tariff_flags = tariffs.result()
+    output = open(output_path, "a", encoding="utf-8") if output_path else None
+    try:
+        for query, hs_code, error in zip(queries, hs_codes, errors):
+            if error is not None:
+                result = {"query": query, "error": error}
+                if output:
+                    output.write(json.dumps(result, default=str) + "\n")
+                    output.flush()
+                yield result
+                continue
+            query_remote = dict(remote, tariffs={code: tariff_flags[(code, hs_code)] for code in wto_codes})
+            scored = _add_query_factors(suppliers.copy(), query["category"], query["product_name"])
+            scored = _add_remote_factors(scored, query_remote, query["source_location"])
+            result = {"query": query, "hs_code": hs_code, "top_suppliers": _score_records(scored)[:top_k]}
+            if explain:
+                product_info = {
+                    "category": query["category"],
+                    "name": query["product_name"],
+                    "source_location": query["source_location"]
+                }
+                result["explanation"] = generate_recommendation_explanation(result["top_suppliers"], product_info)
+            if output:
+                output.write(json.dumps(result, default=str) + "\n")
+                output.flush()
+            yield result
+    finally:
+        if output:
+            output.close()
+# Read batch queries from a CSV or JSON lines file
+def read_batch_queries(path):
+    if path.endswith(".jsonl") or path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    queries = pd.read_csv(path, dtype=str).astype(object)
+    return queries.where(queries.notna(), None).to_dict("records")
+# Recommendation service: a resident process that loads the datasets and warms every index and
+# cache once, then serves recommend_suppliers over a local HTTP/JSON API
+service_host = "127.0.0.1"
+service_port = 8765
+service_url = os.environ.get("SUPPLIER_SERVICE_URL")  # When set, the app and CLI act as thin clients
+service_max_active = 4  # Recommendations computed at once
+service_max_queued = 16  # Requests allowed to wait for a slot; beyond this they are turned away
+service_queue_timeout = 30  # Seconds a queued request waits before it is turned away
+service_client_timeout = 300
+service_max_top_k = 100
+service_workers = None  # Scoring processes per request; clients can't choose it (None scores in-process)
+_service_admission = {"slots": None, "active": 0, "queued": 0, "lock": threading.Lock()}
+_service_client = {"session": None, "lock": threading.Lock()}
+# Recommendation options from a request body; raises ValueError for invalid values
+def _service_options(request):
+    try:
+        top_k = 5 if request.get("top_k") is None else int(request["top_k"])
+    except (TypeError, ValueError):
+        raise ValueError(f"top_k must be an integer, got {request.get('top_k')!r}")
+    if not 1 <= top_k <= service_max_top_k:
+        raise ValueError(f"top_k must be between 1 and {service_max_top_k}, got {top_k}")
+    radius_km = request.get("radius_km")
+    if radius_km is not None:
+        try:
+            radius_km = float(radius_km)
+        except (TypeError, ValueError):
+            raise ValueError(f"radius_km must be a number, got {radius_km!r}")
+        if not radius_km > 0 or radius_km == float("inf"):
+            raise ValueError(f"radius_km must be a positive number, got {radius_km}")
+    return {
+        "top_k": top_k,
+        "radius_km": radius_km,
+        "workers": service_workers,
+        "include_timings": bool(request.get("include_timings"))
+    }
+# Wait for a free slot; returns False when the queue is full or the wait times out
+def _admit_request():
+    admission = _service_admission
+    # A free slot is taken straight away; only requests that would wait count against the queue
+    admitted = admission["slots"].acquire(blocking=False)
+    if not admitted:
+        with admission["lock"]:
+            if admission["queued"] >= service_max_queued:
+                count("service_rejected", reason="queue_full")
+                return False
+            admission["queued"] += 1
+        try:
+            with timed("service_queue_wait"):
+                admitted = admission["slots"].acquire(timeout=service_queue_timeout)
+        finally:
+            with admission["lock"]:
+                admission["queued"] -= 1
+    if not admitted:
+        count("service_rejected", reason="queue_timeout")
+        return False
+    with admission["lock"]:
+        admission["active"] += 1
+    return True
+def _release_request():
+    with _service_admission["lock"]:
+        _service_admission["active"] -= 1
+    _service_admission["slots"].release()
+# Load, queue and dataset state reported by /health
+def service_status(csv_data):
+    with _service_admission["lock"]:
+        return {"status": "ok", "active": _service_admission["active"], "queued": _service_admission["queued"],
+                "max_active": service_max_active, "max_queued": service_max_queued,
+                "dataset_version": dataset_version(csv_data), "weather_refresher": weather_refresher_running()}
+# Load and warm everything a request needs, so only the first start pays for it
+def prepare_service_data(base_path=base_path, compact=True, stream=True, weather_refresh=True):
+    csv_data = load_all_csvs(base_path, snapshot=True, compact=compact, stream=stream)
+    warm_indexes(csv_data)
+    get_supplier_spatial_index(build_supplier_frame(extract_supplier_features(csv_data)))
+    get_llm_client()
+    if weather_refresh:
+        start_weather_refresher(csv_data)
+    return csv_data
+# Start the HTTP/JSON service in a background thread; returns the server (call shutdown() to stop).
+#   GET  /health     load, queue and dataset state
+#   GET  /metrics    Prometheus text format
+#   POST /recommend  {"product_category", "product_name", "source_location", "top_k", "radius_km",
+#                     "stream", "include_timings"}; with "stream" the response is JSON lines:
+#                     {"phase"}..., {"top_suppliers"}, {"chunk"}..., {"timings"}, {"done"}
+#   POST /feedback   {"supplier_name", "feedback", "rating"}
+# Requests beyond the active and queued limits get 503 with Retry-After. A request holds its slot
+# while it is scored, not while its explanation streams
+def start_service(csv_data=None, host=None, port=None):
+    if csv_data is None:
+        csv_data = prepare_service_data()
+    _service_admission["slots"] = threading.BoundedSemaphore(service_max_active)
+    class ServiceHandler(BaseHTTPRequestHandler):
+        # HTTP/1.1 keeps client connections open between requests; streams use chunked framing
+        protocol_version = "HTTP/1.1"
+        timeout = 120  # Idle keep-alive connections are closed after this many seconds
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+        def _write_line(self, payload):
+            line = json.dumps(payload, default=str).encode("utf-8") + b"\n"
+            self.wfile.write(f"{len(line):X}\r\n".encode("ascii") + line + b"\r\n")
+            self.wfile.flush()
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError(f"expected a JSON object, got {type(request).__name__}")
+            return request
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, service_status(csv_data))
+            elif self.path == "/metrics":
+                body = render_prometheus_metrics().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+        def do_POST(self):
+            try:
+                request = self._read_json()
+            except ValueError as e:
+                self._send_json(400, {"error": f"Invalid JSON body: {str(e)}"})
+                return
+            if self.path == "/feedback":
+                if not request.get("supplier_name"):
+                    self._send_json(400, {"error": "Missing fields: supplier_name"})
+                    return
+                try:
+                    aggregate = save_feedback(request["supplier_name"], request.get("feedback", ""),
+                                              request.get("rating"))
+                except (TypeError, ValueError) as e:
+                    self._send_json(400, {"error": str(e)})
+                    return
+                self._send_json(200, {"status": "ok", "aggregate": aggregate})
+            elif self.path == "/recommend":
+                missing = [field for field in ("product_category", "product_name", "source_location")
+                           if not request.get(field)]
+                if missing:
+                    self._send_json(400, {"error": f"Missing fields: {', '.join(missing)}"})
+                    return
+                try:
+                    options = _service_options(request)
+                except ValueError as e:
+                    self._send_json(400, {"error": str(e)})
+                    return
+                if not _admit_request():
+                    self._send_json(503, {"error": "Recommendation service is busy"}, {"Retry-After": "1"})
+                    return
+                released = []
+                def release():
+                    if not released:
+                        released.append(True)
+                        _release_request()
+                try:
+                    with timed("service_request"):
+                        self._recommend(request, options, release)
+                finally:
+                    release()
+            else:
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+        # The admission slot covers scoring only: it is released once the suppliers are ranked,
+        # before the explanation is streamed from the LLM
+        def _recommend(self, request, options, release):
+            stream = bool(request.get("stream"))
+            if not stream:
+                try:
+                    result = recommend_suppliers(request["product_category"], request["product_name"],
+                                                 request["source_location"], csv_data, stream_explanation=True,
+                                                 **options)
+                    release()
+                    result["explanation"] = "".join(result["explanation"])
+                except Exception as e:
+                    print(f"Recommendation service error: {str(e)}")
+                    self._send_json(500, {"error": str(e)})
+                    return
+                self._send_json(200, result)
+                return
+            # Streamed responses go out as chunked JSON lines
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                try:
+                    result = recommend_suppliers(request["product_category"], request["product_name"],
+                                                 request["source_location"], csv_data,
+                                                 progress_callback=lambda phase: self._write_line({"phase": phase}),
+                                                 stream_explanation=True, **options)
+                    self._write_line({"top_suppliers": result["top_suppliers"]})
+                    release()
+                    for chunk in result["explanation"]:
+                        self._write_line({"chunk": chunk})
+                    if "timings" in result:
+                        self._write_line({"timings": result["timings"]})
+                    self._write_line({"done": True})
+                except (BrokenPipeError, ConnectionResetError):
+                    raise
+                except Exception as e:
+                    print(f"Recommendation service error: {str(e)}")
+                    self._write_line({"error": str(e)})
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                print("Recommendation service client disconnected")
+                self.close_connection = True
+        def log_message(self, format, *args):
+            pass
+    server = ThreadingHTTPServer((host or service_host, service_port if port is None else port), ServiceHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="recommendation-service", daemon=True).start()
+    print(f"Recommendation service listening on http://{server.server_address[0]}:{server.server_address[1]}")
+    return server
+# Keep-alive session for talking to the service, created on first use
+def _service_session():
+    with _service_client["lock"]:
+        if _service_client["session"] is None:
+            _service_client["session"] = requests.Session()
+        return _service_client["session"]
+# Error raised for a non-200 service response, with the service's message
+def _service_error(response):
+    try:
+        message = response.json().get("error")
+    except ValueError:
+        message = response.text
+    return RuntimeError(f"Recommendation service returned {response.status_code}: {message}")
+# Read streamed lines up to the ranked suppliers, reporting phases; returns the remaining lines
+def _service_stream_lines(response, progress_callback, result):
+    lines = (json.loads(line) for line in response.iter_lines() if line)
+    for message in lines:
+        if "phase" in message:
+            _report_progress(progress_callback, message["phase"])
+        elif "top_suppliers" in message:
+            result["top_suppliers"] = message["top_suppliers"]
+            break
+        elif "error" in message:
+            raise RuntimeError(f"Recommendation service error: {message['error']}")
+    return lines
+# Explanation chunks from the rest of the stream, closing the response once it ends
+def _service_explanation(lines, response, result):
+    try:
+        for message in lines:
+            if "chunk" in message:
+                yield message["chunk"]
+            elif "timings" in message:
+                result["timings"] = message["timings"]
+            elif "error" in message:
+                raise RuntimeError(f"Recommendation service error: {message['error']}")
+    finally:
+        response.close()
+# Client side of recommend_suppliers: same arguments and result shape, computed by the service at url
+def recommend_suppliers_remote(product_category, product_name, source_location, url=None, progress_callback=None,
+                               top_k=5, stream_explanation=False, include_timings=False, radius_km=None):
+    url = (url or service_url or f"http://{service_host}:{service_port}").rstrip("/")
+    request = {
+        "product_category": product_category,
+        "product_name": product_name,
+        "source_location": source_location,
+        "top_k": top_k,
+        "radius_km": radius_km,
+        "stream": stream_explanation,
+        "include_timings": include_timings
+    }
+    response = _service_session().post(f"{url}/recommend", json=request, stream=stream_explanation,
+                                       timeout=service_client_timeout)
+    if response.status_code != 200:
+        error = _service_error(response)
+        response.close()
+        raise error
+    if not stream_explanation:
+        return response.json()
+    result = {"top_suppliers": None}
+    try:
+        lines = _service_stream_lines(response, progress_callback, result)
+    except Exception:
+        response.close()
+        raise
+    if result["top_suppliers"] is None:
+        response.close()
+        raise RuntimeError("Recommendation service closed the stream before returning suppliers")
+    # Timings arrive after the last chunk, so they are filled in once the explanation is consumed
+    if include_timings:
+        result["timings"] = {"spans": [], "counters": {}}
+    result["explanation"] = _service_explanation(lines, response, result)
+    return result
+# Client side of save_feedback
+def save_feedback_remote(supplier_name, feedback, rating, url=None):
+    url = (url or service_url or f"http://{service_host}:{service_port}").rstrip("/")
+    response = _service_session().post(f"{url}/feedback", timeout=service_client_timeout,
+                                       json={"supplier_name": supplier_name, "feedback": feedback, "rating": rating})
+    if response.status_code != 200:
+        raise _service_error(response)
+    return response.json()["aggregate"]
 # Example usage
 def main():
-    csv_data = load_all_csvs(base_path)
+    parser = argparse.ArgumentParser(description="Supplier recommendation")
+    parser.add_argument("--batch", help="CSV or JSONL file of queries (category, product_name, source_location)")
+    parser.add_argument("--output", help="JSONL file that batch results are appended to")
+    parser.add_argument("--explain", action="store_true", help="Generate an LLM explanation per batch query")
+    parser.add_argument("--top-k", type=int, default=5, help="Suppliers to return per query")
+    parser.add_argument("--compact", action="store_true", help="Load only the columns scoring needs")
+    parser.add_argument("--stream-complaints", action="store_true",
+                        help="Aggregate the complaints file in chunks instead of loading it whole")
+    parser.add_argument("--workers", type=int, help="Score shards of the catalog in this many worker processes")
+    parser.add_argument("--serve", action="store_true", help="Run the recommendation service until interrupted")
+    parser.add_argument("--host", default=service_host, help="Address the service listens on")
+    parser.add_argument("--port", type=int, default=service_port, help="Port the service listens on")
+    parser.add_argument("--service-url", default=service_url,
+                        help="Ask the recommendation service at this URL instead of loading the data here")
+    args = parser.parse_args()
+    if args.serve:
+        global service_workers
+        service_workers = args.workers
+        csv_data = prepare_service_data(base_path, compact=args.compact, stream=args.stream_complaints)
+        server = start_service(csv_data, args.host, args.port)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            print("Shutting down the recommendation service")
+        finally:
+            server.shutdown()
+            stop_weather_refresher()
+            shutdown_scoring_pool()
+        return
+    # A thin client only needs the data for batch runs, which are scored locally
+    csv_data = None
+    if args.batch or not args.service_url:
+        csv_data = load_all_csvs(base_path, compact=args.compact, stream=args.stream_complaints)
+    if args.batch:
+        for result in recommend_suppliers_batch(read_batch_queries(args.batch), csv_data=csv_data, explain=args.explain,
+                                                output_path=args.output, top_k=args.top_k):
+            query = result["query"]
+            if "error" in result:
+                print(f"{query['category']} / {query['product_name']}: skipped ({result['error']})")
+                continue
+            print(f"{query['category']} / {query['product_name']}: "
+                  f"{', '.join(supplier['supplier_name'] for supplier in result['top_suppliers'])}")
+        return
     # Get product info from user
     print("Enter product information:")
     product_category = input("Product Category (e.g., GPS, Medical, Electronics): ")
@@ -513,7 +2700,12 @@ def main():
         city = input("Enter your city: ")
         country = input("Enter your country: ")
         source_location = f"{city}, {country}"
-    result = recommend_suppliers(product_category, product_name, source_location, csv_data)
+    if args.service_url:
+        result = recommend_suppliers_remote(product_category, product_name, source_location, args.service_url,
+                                            stream_explanation=True)
+    else:
+        result = recommend_suppliers(product_category, product_name, source_location, csv_data,
+                                     stream_explanation=True, workers=args.workers)
     print("\nTop 5 Recommended Suppliers:")
     for i, supplier in enumerate(result["top_suppliers"], 1):
         print(f"{i}. {supplier['supplier_name']} (Score: {supplier['score']:.1f})")
@@ -523,8 +2715,11 @@ def main():
               f"Product Match ({supplier['factors']['product_match_factor']}), " +
               f"Expiration ({supplier['factors']['expiration_factor']}), " +
               f"Complaints ({supplier['factors']['complaint_factor']}), " +
-              f"Distance ({supplier['factors']['distance_factor']})")
+              f"Distance ({supplier['factors']['distance_factor']}), " +
+              f"Feedback ({supplier['factors']['feedback_factor']})")
     print("\nExplanation:")
-    print(result["explanation"])
+    for chunk in result["explanation"]:
+        print(chunk, end="", flush=True)
+    print()
 if __name__ == "__main__":
     main()